@@ -0,0 +1,116 @@
+"""
+Helpers for long running batch management commands:
+a process pool runner, a checkpoint file for resuming interrupted runs
+and throughput reporting.
+"""
+from __future__ import annotations
+
+import concurrent.futures
+import logging
+import os
+import time
+from typing import Callable, Iterable, Iterator, Tuple
+
+import django
+from django.db import connections
+
+log = logging.getLogger("django")
+
+
+class Checkpoint:
+    """
+    Append-only file of finished job keys, one per line.
+    If path is None, nothing is persisted.
+    """
+
+    def __init__(self, path: str | None):
+        self.path = path
+        self.done = set()
+        if path and os.path.isfile(path):
+            with open(path, "rt") as f:
+                self.done = {line.strip() for line in f if line.strip()}
+            log.info(f"Resuming from {path}, {len(self.done)} jobs already done")
+
+    def __contains__(self, key) -> bool:
+        return str(key) in self.done
+
+    def add(self, key):
+        key = str(key)
+        self.done.add(key)
+        if self.path:
+            with open(self.path, "at") as f:
+                f.write(key + "\n")
+
+
+class Throughput:
+    """
+    Count finished jobs, contents and encoded media seconds
+    and log the rates every `interval` seconds.
+    """
+
+    def __init__(self, total: int = 0, interval: float = 30.0):
+        self.total = total
+        self.interval = interval
+        self.jobs = self.contents = self.failed = 0
+        self.seconds = 0.0
+        self.start = self.last_report = time.monotonic()
+
+    def update(self, jobs: int = 1, contents: int = 0, seconds: float = 0.0, failed: int = 0):
+        self.jobs += jobs
+        self.contents += contents
+        self.seconds += seconds
+        self.failed += failed
+        if time.monotonic() - self.last_report >= self.interval:
+            self.report()
+
+    def report(self) -> str:
+        self.last_report = time.monotonic()
+        elapsed = max(self.last_report - self.start, 0.001)
+        msg = (
+            f"{self.jobs}/{self.total} jobs ({self.failed} failed), {self.contents} contents, "
+            f"{self.contents / elapsed * 60:.1f} contents/min, "
+            f"{self.seconds / elapsed:.2f} encoded seconds per wall second"
+        )
+        log.info(msg)
+        return msg
+
+
+def _init_worker():
+    # Forked workers must not share parent's database connections
+    django.setup()
+    connections.close_all()
+
+
+def _call(func: Callable, job: tuple):
+    return func(*job)
+
+
+def run_jobs(func: Callable, jobs: Iterable[tuple], workers: int = 1) -> Iterator[Tuple[tuple, object, Exception]]:
+    """
+    Call func(*job) for every job and yield (job, result, error) tuples in completion order.
+    If workers > 1, jobs are run in a pool of `workers` processes, and at most
+    2 * workers jobs are submitted at a time, so `jobs` may be a lazy iterator.
+    """
+    if workers <= 1:
+        for job in jobs:
+            try:
+                yield job, func(*job), None
+            except Exception as err:
+                yield job, None, err
+        return
+    connections.close_all()  # Don't fork open database connections
+    jobs = iter(jobs)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        pending = {}
+        while True:
+            for job in jobs:
+                pending[executor.submit(_call, func, job)] = job
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                break
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                job = pending.pop(future)
+                err = future.exception()
+                yield job, None if err else future.result(), err
@@ -0,0 +1,134 @@
+"""
+Benchmarks of metadata reading and thumbnailing, run them with
+
+    python manage.py benchmark <name> <files or directories>
+
+e.g. python manage.py benchmark thumbnail content/tests/testfiles/image
+
+Every benchmark returns a dict of results, which the command prints.
+"""
+from __future__ import annotations
+
+import concurrent.futures
+import os
+import resource
+import time
+import timeit
+from typing import Callable, Dict, List, Optional
+
+import PIL.Image
+import magic
+
+from content import filetools
+from content.probepool import ProbePool
+
+
+def collect_files(paths: List[str]) -> List[str]:
+    """
+    Return all files in `paths`, directories are walked recursively.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, filenames in os.walk(path):
+                files += [os.path.join(root, f) for f in sorted(filenames)]
+        else:
+            files.append(path)
+    return files
+
+
+def _ms_per_file(elapsed: float, count: int) -> float:
+    return round(elapsed / max(count, 1) * 1000, 3)
+
+
+def bench_probe(files: List[str], workers: int = None) -> dict:
+    """
+    Compare reading mimetype and ffprobe data of `files` one by one in this process
+    to reading them with a ProbePool. ProbeCache is disabled during the benchmark.
+    """
+    cache, filetools.FFProbe.cache = filetools.FFProbe.cache, None
+    try:
+        start = time.perf_counter()
+        for path in files:
+            filetools.get_mimetype(path)
+            filetools.FFProbe(path)
+        serial = time.perf_counter() - start
+        with ProbePool(workers) as pool:  # Worker startup is not measured
+            start = time.perf_counter()
+            for _ in pool.probe_files(files):
+                pass
+            pooled = time.perf_counter() - start
+            workers = pool.workers
+    finally:
+        filetools.FFProbe.cache = cache
+    return {
+        "files": len(files),
+        "workers": workers,
+        "subprocess ms/file": _ms_per_file(serial, len(files)),
+        "pool ms/file": _ms_per_file(pooled, len(files)),
+    }
+
+
+def bench_mimetype(files: List[str], number: int = 100) -> dict:
+    """
+    Compare the per call cost of module level magic.from_buffer() to a cached
+    libmagic handle and to get_mimetype_from_buffer() with its signature fast path.
+    Files are read to memory first, so only mimetype detection is measured.
+    """
+    buffers = []
+    for path in files:
+        with open(path, "rb") as f:
+            buffers.append(f.read(4096))
+    handle = filetools.get_magic()
+    timers = {
+        "magic.from_buffer": lambda: [magic.from_buffer(buf, mime=True) for buf in buffers],
+        "cached handle": lambda: [handle.from_buffer(buf) for buf in buffers],
+        "get_mimetype_from_buffer": lambda: [filetools.get_mimetype_from_buffer(buf) for buf in buffers],
+    }
+    results = {"files": len(files)}
+    for name, func in timers.items():
+        elapsed = timeit.timeit(func, number=number)
+        results[f"{name} us/call"] = round(elapsed / (number * max(len(buffers), 1)) * 1000000, 2)
+    fast = [buf for buf in buffers if filetools.get_mimetype_from_signature(buf)]
+    results["signature hits"] = len(fast)
+    return results
+
+
+def _thumbnail_run(files: List[str], size: int, reducing_gap: Optional[float]) -> tuple:
+    # Run in a fresh process, so ru_maxrss shows the peak memory of this run only
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    for path in files:
+        with PIL.Image.open(path) as im:
+            filetools.scale_image(im, (size, size), reducing_gap=reducing_gap)
+    elapsed = time.perf_counter() - start
+    return elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+
+
+def bench_thumbnail(files: List[str], size: int = 1600, gaps: tuple = (None, 3.0, 2.0, 1.0)) -> dict:
+    """
+    Measure time and peak memory of scaling images to `size` with different reducing gaps.
+    Gap None is the old full decode and LANCZOS resampling. Files which are not images are skipped.
+    """
+    images = []
+    for path in files:
+        try:
+            with PIL.Image.open(path):
+                images.append(path)
+        except IOError:
+            pass
+    results = {"images": len(images)}
+    for gap in gaps:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+            elapsed, peak_kb = executor.submit(_thumbnail_run, images, size, gap).result()
+        name = "full decode" if gap is None else f"reducing_gap={gap}"
+        results[f"{name} ms/image"] = _ms_per_file(elapsed, len(images))
+        results[f"{name} peak MB"] = round(peak_kb / 1024, 1)
+    return results
+
+
+BENCHMARKS: Dict[str, Callable[..., dict]] = {
+    "probe": bench_probe,
+    "mimetype": bench_mimetype,
+    "thumbnail": bench_thumbnail,
+}
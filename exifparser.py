@@ -13,9 +13,11 @@ if they were available:
 """
 
 import datetime
+import functools
 import logging
+import threading
 from fractions import Fraction
-from typing import Optional
+from typing import Iterable, List, Optional, Tuple
 from zoneinfo import ZoneInfo
 
 import exifread
@@ -23,6 +25,49 @@ import timezonefinder
 
 log = logging.getLogger("exifparser")
 
+# Coordinates are rounded to this many decimals (~110 m) before timezone lookup,
+# so photos taken at the same place share a cached result
+TIMEZONE_PRECISION = 3
+_timezone_finder = None
+_timezone_lock = threading.Lock()
+
+
+def get_timezone_finder() -> timezonefinder.TimezoneFinder:
+    """
+    Return process-wide TimezoneFinder, which is created on first use,
+    because loading its polygon data takes a long time.
+    """
+    global _timezone_finder
+    if _timezone_finder is None:
+        with _timezone_lock:
+            if _timezone_finder is None:
+                _timezone_finder = timezonefinder.TimezoneFinder()
+    return _timezone_finder
+
+
+@functools.lru_cache(maxsize=4096)
+def _timezone_at(lat: float, lon: float) -> Optional[str]:
+    finder = get_timezone_finder()
+    with _timezone_lock:
+        return finder.timezone_at(lng=lon, lat=lat)
+
+
+def timezone_at(lat: float, lon: float) -> Optional[str]:
+    """
+    Return timezone name (e.g. 'Europe/Helsinki') of a location or None if it is not known.
+    """
+    return _timezone_at(round(lat, TIMEZONE_PRECISION), round(lon, TIMEZONE_PRECISION))
+
+
+def timezones_at(points: Iterable[Tuple[float, float]]) -> List[Optional[str]]:
+    """
+    Return timezone names of (lat, lon) pairs, e.g. for all photos of an import job.
+    Every distinct rounded location is looked up only once.
+    """
+    keys = [(round(lat, TIMEZONE_PRECISION), round(lon, TIMEZONE_PRECISION)) for lat, lon in points]
+    timezones = {key: _timezone_at(*key) for key in set(keys)}
+    return [timezones[key] for key in keys]
+
 
 def read_exif(filepath: str, details: bool = False) -> dict:
     """
@@ -198,8 +243,7 @@ def parse_datetime(exif: dict, tag_name="EXIF DateTimeOriginal", gps=None) -> di
             data["creation_time"] = datetime.datetime.strptime(val, "%Y:%m:%d %H:%M:%S")
             # Determine timezone from latitude and longitude, if they are present
             if gps is not None and "lat" in gps and "lon" in gps:
-                tf = timezonefinder.TimezoneFinder()
-                tz = tf.timezone_at(lng=gps["lon"], lat=gps["lat"])
+                tz = timezone_at(gps["lat"], gps["lon"])
                 data["creation_time"] = data["creation_time"].replace(tzinfo=ZoneInfo(tz))
         except ValueError as err:  # E.g. value is '0000:00:00 00:00:00\x00'
             log.warning("parse_datetime({}) failed: {}".format(orig_val, err))
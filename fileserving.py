@@ -0,0 +1,170 @@
+"""
+Helpers for serving files: HTTP Range requests (RFC 7233) and
+offloading file transfer to the web server using X-Sendfile
+or X-Accel-Redirect header.
+
+Offloading is configured per storage in settings, e.g.
+
+CONTENT_SENDFILE = {
+    "content": {"header": "X-Accel-Redirect", "url": "/protected/content/"},
+    "video": {"header": "X-Accel-Redirect", "url": "/protected/video/"},
+    "audio": {"header": "X-Sendfile"},
+}
+
+X-Accel-Redirect (nginx) needs an internal location, whose URL is given in "url"
+and which points to storage's location. X-Sendfile (Apache, lighttpd) uses
+absolute file paths. The web server takes care of Range requests, when file
+transfer is offloaded.
+"""
+from __future__ import annotations
+
+import os
+import secrets
+from typing import BinaryIO, List, Optional, Tuple
+from urllib.parse import quote
+
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+
+# Max number of ranges in one request, more than this is probably abuse
+MAX_RANGES = 16
+BLOCK_SIZE = 65536
+
+
+def parse_range_header(header: str | None, size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parse Range header value, e.g. 'bytes=0-499,-500'.
+    Return a list of (first, last) byte positions (inclusive), an empty list if
+    none of the ranges are satisfiable or None if the header is missing or
+    invalid, in which case the whole file should be returned.
+    """
+    if not header:
+        return None
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes" or not specs:
+        return None
+    specs = specs.split(",")
+    if len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        first, sep, last = spec.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if first == "":  # Suffix range, e.g. '-500' is the last 500 bytes
+                length = int(last)
+                if length <= 0:
+                    continue
+                ranges.append((max(size - length, 0), size - 1))
+                continue
+            first = int(first)
+            last = int(last) if last else None
+        except ValueError:
+            return None
+        if first < 0 or (last is not None and first > last):
+            return None
+        if first >= size:  # Unsatisfiable
+            continue
+        if last is None:
+            last = size - 1
+        ranges.append((first, min(last, size - 1)))
+    return ranges
+
+
+def if_range_matches(request, etag: str | None, last_modified: int | None) -> bool:
+    """
+    Return True if there is no If-Range header or it matches the current version of the file.
+    """
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if not if_range:
+        return True
+    if if_range.startswith(('"', 'W/"')):
+        # Weak ETags must not be used with If-Range
+        return etag is not None and if_range == etag
+    return last_modified is not None and parse_http_date_safe(if_range) == last_modified
+
+
+def _iter_ranges(f: BinaryIO, ranges: List[Tuple[int, int]], parts: List[bytes] = None):
+    """
+    Yield byte ranges from f, optionally preceded by multipart part headers.
+    File is closed when iteration ends or the response is closed.
+    """
+    try:
+        for i, (first, last) in enumerate(ranges):
+            if parts:
+                yield parts[i]
+            f.seek(first)
+            remaining = last - first + 1
+            while remaining > 0:
+                chunk = f.read(min(BLOCK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        if parts:
+            yield parts[-1]
+    finally:
+        f.close()
+
+
+def range_response(
+    request,
+    f: BinaryIO,
+    size: int,
+    content_type: str,
+    etag: str | None = None,
+    last_modified: int | None = None,
+) -> StreamingHttpResponse | HttpResponse | None:
+    """
+    Return 206 Partial Content (or 416 Range Not Satisfiable) response
+    for open file `f`, if request has a valid Range header.
+    Otherwise return None and leave `f` open, so the caller can return the
+    whole file.
+    """
+    ranges = parse_range_header(request.META.get("HTTP_RANGE"), size)
+    if ranges is None or not if_range_matches(request, etag, last_modified):
+        return None
+    if not ranges:
+        f.close()
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{size}"
+        return response
+    if len(ranges) == 1:
+        first, last = ranges[0]
+        response = StreamingHttpResponse(_iter_ranges(f, ranges), status=206, content_type=content_type)
+        response["Content-Range"] = f"bytes {first}-{last}/{size}"
+        response["Content-Length"] = last - first + 1
+    else:
+        boundary = secrets.token_hex(16)
+        part_header = "\r\n--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n"
+        parts = [part_header.format(boundary, content_type, first, last, size).encode() for first, last in ranges]
+        parts.append(f"\r\n--{boundary}--\r\n".encode())
+        length = sum(len(p) for p in parts) + sum(last - first + 1 for first, last in ranges)
+        response = StreamingHttpResponse(
+            _iter_ranges(f, ranges, parts),
+            status=206,
+            content_type=f"multipart/byteranges; boundary={boundary}",
+        )
+        response["Content-Length"] = length
+    response["Accept-Ranges"] = "bytes"
+    if last_modified:
+        response["Last-Modified"] = http_date(last_modified)
+    if etag:
+        response["ETag"] = etag
+    return response
+
+
+def sendfile_response(path: str, location: str, config: dict, content_type: str) -> HttpResponse:
+    """
+    Return an empty response, which tells the web server to send file `path`
+    (which is in a storage located in `location`) to the client.
+    """
+    header = config.get("header", "X-Sendfile")
+    response = HttpResponse(content_type=content_type)
+    if header.lower() == "x-accel-redirect":
+        relpath = os.path.relpath(path, location)
+        response[header] = config["url"].rstrip("/") + "/" + quote(relpath.replace(os.sep, "/"))
+    else:
+        response[header] = path
+    return response
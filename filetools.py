@@ -3,16 +3,24 @@ Read as much metadata from a file as possible. Mainly usable with
 media files (image, video, audio files), but can do also video and pdf
 thumbnail.
 """
+from __future__ import annotations
+
+import collections
 import datetime
+import functools
 import hashlib
 import io
 import json
 import logging
 import os
 import re
+import shutil
+import signal
 import subprocess
 import tempfile
-from typing import Tuple
+import threading
+import time
+from typing import List, NamedTuple, Optional, Tuple
 
 import magic
 from PIL import Image
@@ -20,10 +28,168 @@ from dateutil import parser
 from iptcinfo3 import IPTCInfo
 
 from content.exifparser import read_exif, parse_datetime, parse_gps
+from content.probecache import ProbeCache
+from content.profiles import Profile, configured_profiles, select_profiles
 
 
 # from .exifparser import read_exif, parse_datetime, parse_gps
 
+# Number of times each external tool or parser has been run (and images decoded),
+# tests use this to check that every file is probed and decoded only once.
+CALL_COUNTER = collections.Counter()
+
+# Limits for external commands, see configure_runner()
+RUNNER_LIMITS = {
+    "timeout": 3600,  # Max wall clock seconds of ffmpeg and convert commands
+    "probe_timeout": 60,  # Max wall clock seconds of ffprobe
+    "nice": 10,  # Added to niceness of child processes
+    "threads": 0,  # ffmpeg -threads, 0 lets ffmpeg decide
+    "memory": None,  # Max address space of child processes in bytes
+}
+
+
+def configure_runner(**limits):
+    """
+    Update RUNNER_LIMITS, e.g. configure_runner(timeout=600, threads=2).
+    """
+    unknown = set(limits) - set(RUNNER_LIMITS)
+    if unknown:
+        raise ValueError(f"Unknown runner limits: {', '.join(sorted(unknown))}")
+    RUNNER_LIMITS.update(limits)
+
+
+class RunResult(NamedTuple):
+    """
+    Result of a command run with run_command(). Progress stats (frames, fps, speed
+    and processed media time in seconds) are parsed from ffmpeg's stderr.
+    """
+
+    command: str
+    returncode: int
+    elapsed: float
+    timed_out: bool = False
+    stdout: bytes = b""
+    stderr: str = ""
+    frames: Optional[int] = None
+    fps: Optional[float] = None
+    speed: Optional[float] = None
+    time: Optional[float] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0 and not self.timed_out
+
+
+FFMPEG_STATS_RE = {
+    "frames": re.compile(r"frame=\s*(\d+)"),
+    "fps": re.compile(r"fps=\s*([\d.]+)"),
+    "speed": re.compile(r"speed=\s*([\d.]+)x"),
+    "time": re.compile(r"time=\s*(\d+):(\d+):([\d.]+)"),
+}
+
+
+def parse_ffmpeg_stats(stderr: str) -> dict:
+    """
+    Return the last progress values ffmpeg printed to stderr.
+    """
+    stats = {}
+    for key, regex in FFMPEG_STATS_RE.items():
+        matches = regex.findall(stderr)
+        if not matches:
+            continue
+        last = matches[-1]
+        if key == "frames":
+            stats[key] = int(last)
+        elif key == "time":
+            stats[key] = int(last[0]) * 3600 + int(last[1]) * 60 + float(last[2])
+        else:
+            stats[key] = float(last)
+    return stats
+
+
+@functools.lru_cache(maxsize=None)
+def _which(name: str) -> Optional[str]:
+    return shutil.which(name)
+
+
+def limit_prefix(nice: int, memory: Optional[int]) -> list:
+    """
+    Return a command prefix, which lowers the priority and memory limit of the command,
+    e.g. ['nice', '-n', '10', 'prlimit', '--as=1000000000']. nice and prlimit exec the
+    command in the same process, so it is still killed with its process group.
+    Limits whose tool is not installed are skipped.
+    NOTE: preexec_fn is not used, because it is unsafe in threaded processes.
+    """
+    prefix = []
+    if nice and _which("nice"):
+        prefix += ["nice", "-n", str(nice)]
+    if memory and _which("prlimit"):
+        prefix += ["prlimit", f"--as={memory}"]
+    return prefix
+
+
+def run_command(cmd: list, timeout: float = None) -> RunResult:
+    """
+    Run `cmd` in its own process group with RUNNER_LIMITS and wait for it to finish.
+    The whole process group is killed, if it runs longer than `timeout` seconds
+    (default RUNNER_LIMITS["timeout"]). OSError is raised if the executable is not found.
+    """
+    if timeout is None:
+        timeout = RUNNER_LIMITS["timeout"]
+    cmd_str = " ".join(cmd)
+    logging.debug(cmd_str)
+    prefix = limit_prefix(RUNNER_LIMITS["nice"], RUNNER_LIMITS["memory"])
+    if prefix and _which(cmd[0]) is None:  # Would be nice's exit code 127 instead of OSError
+        raise FileNotFoundError(f"Command not found: {cmd[0]}")
+    start = time.monotonic()
+    p = subprocess.Popen(
+        prefix + list(cmd),
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=True,
+    )
+    timed_out = False
+    try:
+        stdout, stderr = p.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        os.killpg(p.pid, signal.SIGKILL)
+        stdout, stderr = p.communicate()  # Reap the process
+        logging.error(f"Killed after {timeout} seconds: {cmd_str}")
+    stderr = stderr.decode("utf-8", "replace")
+    result = RunResult(
+        command=cmd_str,
+        returncode=p.returncode,
+        elapsed=time.monotonic() - start,
+        timed_out=timed_out,
+        stdout=stdout,
+        stderr=stderr[-4096:],
+        **parse_ffmpeg_stats(stderr[-4096:]),
+    )
+    if not result.ok and not timed_out:
+        logging.warning(f"Exit code {p.returncode}: {cmd_str}\n{result.stderr[-1024:]}")
+    return result
+
+
+def ffmpeg_command(filepath: str, seek: float = None) -> list:
+    """
+    Return the beginning of an ffmpeg command reading `filepath`, outputs are appended to it.
+    """
+    cmd = ["ffmpeg", "-nostdin", "-y"]
+    if seek is not None:
+        cmd += ["-ss", str(seek)]  # Before -i to seek the input fast
+    return cmd + ["-i", filepath]
+
+
+def ffmpeg_output_params() -> list:
+    """
+    Return per output ffmpeg parameters from RUNNER_LIMITS.
+    """
+    if RUNNER_LIMITS["threads"]:
+        return ["-threads", str(RUNNER_LIMITS["threads"])]
+    return []
+
 
 class FFProbe:
     """
@@ -44,11 +210,19 @@ class FFProbe:
     }
 
     ffprobe = "ffprobe"  # TODO: try to find full path of ffprobe
+    # Persistent ProbeCache shared by all instances, None disables caching
+    cache: Optional[ProbeCache] = None
 
-    def __init__(self, path):
+    def __init__(self, path, sha1: str = None, data: dict = None):
+        """
+        If `sha1` of the file is known, cached results are looked up by it instead of path, size and mtime.
+        If ffprobe's output `data` is given (e.g. from a ProbePool worker), ffprobe is not run.
+        """
         self.path = path
-        self.data = None
-        self.get_streams_dict()
+        self.sha1 = sha1
+        self.data = data
+        if data is None:
+            self.get_streams_dict()
 
     def get_streams_dict(self):
         """
@@ -60,20 +234,20 @@ class FFProbe:
         because the file is not parsable by ffprobe/ffmpeg), returns
         an empty dictionary
         """
+        key = self.cache.file_key(self.path, self.sha1) if self.cache else None
+        if key is not None:
+            data = self.cache.get(key)
+            if data is not None:
+                self.data = data
+                return True
         command = self._ffprobe_command(self.path)
-        logging.debug(" ".join(command))
-        try:
-            output = subprocess.check_output(command, stderr=subprocess.DEVNULL)
-        except subprocess.CalledProcessError as err:  # Probably file not found
-            # TODO: log file and error here.
-            logging.error("Subprocess error: {}".format(err, " ".join(command)))
-            output = "{}"  # empty json object
-            # raise
-        except OSError as err:  # Probably executable was not found
-            # TODO: log file and error here.
-            logging.error("OSError: {}".format(err, " ".join(command)))
-            raise
+        CALL_COUNTER["ffprobe"] += 1
+        # OSError is raised if the executable was not found
+        result = run_command(command, timeout=RUNNER_LIMITS["probe_timeout"])
+        output = result.stdout if result.ok else "{}"  # Probably file not found or not a media file
         self.data = json.loads(output)
+        if key is not None and result.ok:
+            self.cache.put(key, self.data)
         # print(json.dumps(self.data, indent=1))
         return True
 
@@ -227,6 +401,31 @@ def hashfile(filepath: str) -> Tuple[str, str]:
     return md5.hexdigest(), sha1.hexdigest()
 
 
+class StreamHasher:
+    """
+    Compute md5 and sha1 of a file and keep its first bytes (for libmagic)
+    while the file is being copied chunk by chunk, so the data is read only once.
+    """
+
+    head_size = 4096
+
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.sha1 = hashlib.sha1()
+        self.head = b""
+        self.size = 0
+
+    def update(self, chunk: bytes):
+        self.md5.update(chunk)
+        self.sha1.update(chunk)
+        if len(self.head) < self.head_size:
+            self.head += chunk[: self.head_size - len(self.head)]
+        self.size += len(chunk)
+
+    def hexdigests(self) -> Tuple[str, str]:
+        return self.md5.hexdigest(), self.sha1.hexdigest()
+
+
 def guess_encoding(b: bytes) -> str:
     """
     NOTE: this is from Python 2.x times and outdated. Kept here for now, though.
@@ -252,8 +451,99 @@ def get_mimetype(filepath: str) -> str:
     and using python-magic.
     """
     with open(filepath, "rb") as f:
-        mimetype = magic.from_buffer(f.read(4096), mime=True)
-    return mimetype
+        return get_mimetype_from_buffer(f.read(4096))
+
+
+# Content.mediatype values, see get_mediatype()
+MEDIATYPES = ["image", "video", "audio", "document", "other"]
+DOCUMENT_MIMETYPES = {
+    "application/pdf",
+    "application/rtf",
+    "application/msword",
+    "application/vnd.ms-excel",
+    "application/vnd.ms-powerpoint",
+}
+DOCUMENT_MIMETYPE_PREFIXES = (
+    "text/",
+    "application/vnd.openxmlformats-officedocument.",
+    "application/vnd.oasis.opendocument.",
+)
+
+
+def get_mediatype(mimetype: Optional[str]) -> str:
+    """
+    Return major media type of a mimetype: image, video, audio, document or other.
+    """
+    if not mimetype:
+        return "other"
+    major = mimetype.split("/")[0]
+    if major in ("image", "video", "audio"):
+        return major
+    if mimetype in DOCUMENT_MIMETYPES or mimetype.startswith(DOCUMENT_MIMETYPE_PREFIXES):
+        return "document"
+    return "other"
+
+
+# ISO base media file format (MP4, 3GP, HEIC) major brands and their mimetypes
+# as libmagic reports them
+FTYP_BRANDS = {
+    b"isom": "video/mp4",
+    b"iso2": "video/mp4",
+    b"mp41": "video/mp4",
+    b"mp42": "video/mp4",
+    b"avc1": "video/mp4",
+    b"3gp4": "video/3gpp",
+    b"3gp5": "video/3gpp",
+    b"3gp6": "video/3gpp",
+    b"3gg6": "video/3gpp",
+    b"qt  ": "video/quicktime",
+    b"heic": "image/heic",
+    b"heix": "image/heic",
+}
+
+# Signatures of the most common uploaded formats, these are detected without libmagic
+SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"%PDF-", "application/pdf"),
+]
+
+_magic_local = threading.local()
+
+
+def get_magic() -> magic.Magic:
+    """
+    Return libmagic handle of the current thread. Handles are created once
+    and reused, because creating one loads the whole magic database
+    and a handle must not be used by several threads at the same time.
+    """
+    handle = getattr(_magic_local, "handle", None)
+    if handle is None:
+        handle = _magic_local.handle = magic.Magic(mime=True)
+    return handle
+
+
+def get_mimetype_from_signature(buf: bytes) -> Optional[str]:
+    """
+    Return mimetype of a common file format from its first bytes or None if it is not recognized.
+    """
+    for signature, mimetype in SIGNATURES:
+        if buf.startswith(signature):
+            return mimetype
+    if buf[4:8] == b"ftyp":
+        return FTYP_BRANDS.get(buf[8:12])
+    return None
+
+
+def get_mimetype_from_buffer(buf: bytes) -> str:
+    """
+    Return mimetype of a file, whose first bytes (at least 4 KB if available) are in `buf`.
+    """
+    mimetype = get_mimetype_from_signature(buf)
+    if mimetype is not None:
+        return mimetype
+    CALL_COUNTER["magic"] += 1
+    return get_magic().from_buffer(buf)
 
 
 def get_imageinfo(filepath: str) -> dict:
@@ -261,11 +551,13 @@ def get_imageinfo(filepath: str) -> dict:
     Return EXIF and IPTC information found from image file in a dictionary.
     """
     info = {}
+    CALL_COUNTER["exif"] += 1
     info["exif"] = exif = read_exif(filepath)
     info["gps"] = gps = parse_gps(exif)
     info.update(parse_datetime(exif, tag_name="EXIF DateTimeOriginal", gps=gps))
     if "lat" in gps:  # Backwards compatibility
         info["lat"], info["lon"] = gps["lat"], gps["lon"]
+    CALL_COUNTER["iptc"] += 1
     info["iptc"] = iptc = IPTCInfo(filepath, force=True)
     try:
         if iptc.data["caption/abstract"]:
@@ -281,27 +573,36 @@ def get_imageinfo(filepath: str) -> dict:
                 info[key] = str(info[key], guess_encoding(info[key]))
     except AttributeError:
         pass
-    with open(str(filepath), "rb") as f:
-        im = Image.open(f)
-        info["width"], info["height"] = im.size
-        del im
+    info["width"], info["height"] = get_image_size(filepath)
     return info
 
 
-def fileinfo(filepath: str) -> dict:
+def get_image_size(filepath: str) -> Tuple[int, int]:
+    """
+    Return width and height of an image. Only the header is read, pixel data is not decoded.
+    Raise IOError if file is not an image.
+    """
+    with Image.open(str(filepath)) as im:
+        return im.size
+
+
+def fileinfo(filepath: str, probe: FileProbe = None) -> dict:
     """
     Return some information from file found in 'filepath'.
     filemtime, filesize and mimetype are always present.
     Image, Video and audio files may have also width, height, duration,
     creation_time, lat, lon (gps coordinates) etc. info.
     Images may have also some exif and IPTC field parsed.
+    If `probe` is given, already read metadata is reused from it.
     """
+    if probe is None:
+        probe = FileProbe(filepath)
     info = {}
     # Get quickly mimetype first, because we don't want to run FFProbe
     # for e.g. xml files
-    mimetype = get_mimetype(filepath)
+    mimetype = probe.mimetype
     if mimetype.startswith(("video/", "audio/")):
-        ffp = FFProbe(filepath)
+        ffp = probe.ffprobe
         if ffp.is_video():
             info = ffp.get_videoinfo()
         elif ffp.is_audio():
@@ -311,7 +612,7 @@ def fileinfo(filepath: str) -> dict:
                 info["mimetype"] = mimetype.replace("video", "audio")
     elif mimetype.startswith(("image/",)) or mimetype in ("application/pdf",):
         try:
-            info = get_imageinfo(filepath)
+            info = dict(probe.imageinfo)
             if "exif" in info:
                 del info["exif"]
         except IOError:  # is not image
@@ -325,39 +626,157 @@ def fileinfo(filepath: str) -> dict:
     return info
 
 
-def run_ffmpeg(filepath: str, params: list, outfile: str = None, ext: str = None) -> Tuple[str, str, bytes]:
+class FileProbe:
+    """
+    All metadata of one file: mimetype, ffprobe output, EXIF, IPTC and dimensions.
+    Every part is read lazily when it is needed for the first time and then reused,
+    so pass the same FileProbe everywhere the same file is handled.
+    If `pool` (a content.probepool.ProbePool) is set, mimetype and ffprobe are read in its workers.
+    """
+
+    pool = None
+
+    def __init__(self, path: str, mimetype: str = None, sha1: str = None):
+        self.path = path
+        self.sha1 = sha1
+        self._mimetype = mimetype
+        self._ffprobe = None
+        self._imageinfo = None
+        self._imageinfo_error = None
+        self._fileinfo = None
+
+    @property
+    def mimetype(self) -> str:
+        if self._mimetype is None:
+            if self.pool is not None:
+                self._mimetype = self.pool.mimetype(self.path)
+            else:
+                self._mimetype = get_mimetype(self.path)
+        return self._mimetype
+
+    @property
+    def ffprobe(self) -> FFProbe:
+        if self._ffprobe is None:
+            if self.pool is not None:
+                self._ffprobe = self.pool.ffprobe(self.path, sha1=self.sha1)
+            else:
+                self._ffprobe = FFProbe(self.path, sha1=self.sha1)
+        return self._ffprobe
+
+    @property
+    def imageinfo(self) -> dict:
+        """
+        Return get_imageinfo() result. Raise IOError if file is not an image.
+        """
+        if self._imageinfo_error is not None:
+            raise self._imageinfo_error
+        if self._imageinfo is None:
+            try:
+                self._imageinfo = get_imageinfo(self.path)
+            except IOError as err:
+                self._imageinfo_error = err
+                raise
+        return self._imageinfo
+
+    def fileinfo(self) -> dict:
+        if self._fileinfo is None:
+            self._fileinfo = fileinfo(self.path, probe=self)
+        return self._fileinfo
+
+
+def temporary_filename(ext: str) -> str:
+    """
+    Create an empty temporary file with extension `ext` and return its name.
+    ffmpeg overwrites it (-y) and the caller must delete it.
+    """
+    fd, name = tempfile.mkstemp(suffix="." + ext)
+    os.close(fd)
+    return name
+
+
+def run_ffmpeg(filepath: str, params: list, outfile: str = None, ext: str = None) -> Tuple[str, RunResult]:
     """
     Run ffmpeg command for `filepath`, using `params`.
-    Return output file name, the actual command which was run and command's stdout output.
-    Commands stderr is piped to devnull.
+    Return output file name and the RunResult of the command (see result.command and result.ok).
+    Failed commands are logged, see run_command().
     """
     if outfile is None:
-        outfile = "{}.{}".format(tempfile.NamedTemporaryFile(delete=False).name, ext)
-    ffmpeg_cmd = ["ffmpeg", "-i", filepath]
-    full_cmd = ffmpeg_cmd + params + [outfile]
-    cmd_str = " ".join(full_cmd)
-    logging.debug(cmd_str)
-    p = subprocess.Popen(full_cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-    output = p.stdout.read()
-    return outfile, cmd_str, output
+        outfile = temporary_filename(ext)
+    full_cmd = ffmpeg_command(filepath) + list(params) + ffmpeg_output_params() + [outfile]
+    return outfile, run_command(full_cmd)
+
 
+def default_profile(kind: str, name: str = None) -> Profile:
+    """
+    Return the configured transcoding profile `name` of `kind` ('video' or 'audio'),
+    or the first configured profile of `kind`, if there is no such profile.
+    """
+    profiles = configured_profiles()
+    if name in profiles and profiles[name].kind == kind:
+        return profiles[name]
+    selected = select_profiles(profiles, kind)
+    if not selected:
+        raise ValueError(f"No {kind} transcoding profiles configured")
+    return selected[0]
 
-def create_videoinstance(filepath: str, params: list = (), outfile=None, ext="webm") -> Tuple[str, str, bytes]:
+
+def create_videoinstance(filepath: str, params: list = (), outfile=None, ext=None) -> Tuple[str, RunResult]:
     if not params:
-        params = ["-acodec", "libvorbis", "-ac", "2", "-ab", "96k", "-ar", "22050", "-b", "345k", "-s", "320x240"]
-    return run_ffmpeg(filepath, params, outfile, ext)
+        profile = default_profile("video", ext or "webm")
+        params, ext = profile.ffmpeg_params(), ext or profile.ext
+    return run_ffmpeg(filepath, params, outfile, ext or "webm")
 
 
-def create_audioinstance(filepath: str, params=(), outfile=None, ext="mp3") -> Tuple[str, str, bytes]:
+def create_audioinstance(filepath: str, params=(), outfile=None, ext=None) -> Tuple[str, RunResult]:
     if not params:
-        params = ["-acodec", "libmp3lame", "-ab", "64k"]
-    return run_ffmpeg(filepath, params, outfile, ext)
+        profile = default_profile("audio", ext or "mp3")
+        params, ext = profile.ffmpeg_params(), ext or profile.ext
+    return run_ffmpeg(filepath, params, outfile, ext or "mp3")
+
 
+# Video thumbnails and posters are taken at this time, see do_video_thumbnail() and transcode()
+VIDEO_THUMBNAIL_SEC = 1.0
 
-def do_video_thumbnail(src: str, target: str, sec=1.0):
+
+def transcode(
+    filepath: str, outputs: list, thumbnail: str = None, sec: float = VIDEO_THUMBNAIL_SEC
+) -> Tuple[RunResult, List[Tuple[str, dict]]]:
+    """
+    Transcode `filepath` into several outputs with a single ffmpeg process,
+    so the source is decoded only once. `outputs` is a list of
+    (kind, params, ext) tuples, where kind is 'video' or 'audio'.
+    If `thumbnail` is given, a JPEG poster frame taken at `sec` seconds is saved there too.
+    Return the RunResult of the command and a list of (outfile, info) tuples
+    in the same order as `outputs`. Info is probed from the output file
+    and it is empty if the output is missing or broken.
+    """
+    full_cmd = ffmpeg_command(filepath)
+    outfiles = []
+    for kind, params, ext in outputs:
+        outfile = temporary_filename(ext)
+        outfiles.append(outfile)
+        full_cmd += list(params) + ffmpeg_output_params() + [outfile]
+    if thumbnail:
+        # Output side -ss decodes up to `sec` only once, because the same decoder feeds all outputs
+        full_cmd += ["-ss", str(sec), "-frames:v", "1", "-an", "-f", "mjpeg", thumbnail]
+    result = run_command(full_cmd)
+    if result.ok:
+        logging.info(f"Transcoded {result.time}s of media in {result.elapsed:.1f}s, speed {result.speed}x")
+    results = []
+    for (kind, params, ext), outfile in zip(outputs, outfiles):
+        info = {}
+        # Outputs of a failed or killed process may be truncated, don't trust them
+        if result.ok and os.path.isfile(outfile) and os.path.getsize(outfile) > 0:
+            ffp = FFProbe(outfile)
+            info = ffp.get_videoinfo() if kind == "video" else ffp.get_audioinfo()
+        results.append((outfile, info))
+    return result, results
+
+
+def do_video_thumbnail(src: str, target: str, sec=VIDEO_THUMBNAIL_SEC):
     """
     Create a thumbnail from video file 'src' and save it to 'target'.
-    Return True if subprocess was called with error code 0.
+    Return True if ffmpeg exited with code 0 and target exists.
     TODO: make -ss configurable, now it is hardcoded 1 seconds.
 
     subprocess.check_call([
@@ -367,19 +786,11 @@ def do_video_thumbnail(src: str, target: str, sec=1.0):
         ffmpeg -ss 2 -i test.mp4 -vframes 1 -f mjpeg -s 320x240 test-2.jpg
         ffmpeg -ss 3 -i test.mp4 -vframes 1 -f mjpeg -s 320x240 test-3.jpg
     """
-    try:
-        # FIXME: this fails to create thumbnail if the seconds value after -ss exeeds clip length
-        # NOTE: keep -ss before -i
-        ffmpeg_cmd = ["ffmpeg", "-y", "-ss", str(sec), "-i", src, "-vframes", "1", "-f", "mjpeg", target]
-        logging.debug(ffmpeg_cmd)
-        subprocess.check_call(ffmpeg_cmd, stderr=subprocess.DEVNULL)
-        if os.path.isfile(target):  # TODO: check that size > 0 ?
-            return True
-        else:
-            return False
-    except subprocess.CalledProcessError:
-        # TODO: log file and error here.
-        return False
+    # FIXME: this fails to create thumbnail if the seconds value after -ss exeeds clip length
+    ffmpeg_cmd = ffmpeg_command(src, seek=sec) + ["-vframes", "1", "-f", "mjpeg"] + ffmpeg_output_params() + [target]
+    result = run_command(ffmpeg_cmd)
+    # TODO: check that size > 0 ?
+    return result.ok and os.path.isfile(target)
 
 
 def do_pdf_thumbnail(src: str, target: str) -> bool:
@@ -389,43 +800,76 @@ def do_pdf_thumbnail(src: str, target: str) -> bool:
     """
     convert = "convert"
     # convert -flatten  -geometry 1000x1000 foo.pdf[0] thumb.png
-    try:
-        cmd = [convert, "-flatten", "-geometry", "1000x1000", src + "[0]", target]
-        logging.debug(cmd)
-        subprocess.check_call(cmd, stderr=subprocess.DEVNULL)
-        # TODO: check also that target is really non-broken file
-        if os.path.isfile(target):  # TODO: check that size > 0 ?
-            return True
-        else:
-            return False
-    except subprocess.CalledProcessError:
-        # TODO: log file and error here.
-        return False
+    cmd = [convert, "-flatten", "-geometry", "1000x1000", src + "[0]", target]
+    result = run_command(cmd)
+    # TODO: check also that target is really non-broken file
+    return result.ok and os.path.isfile(target)
+
 
+# Default Pillow reducing_gap for thumbnails, see scale_image()
+THUMBNAIL_REDUCING_GAP = 2.0
 
-def create_thumbnail(filepath: str, t: list) -> io.BytesIO:
+
+def scale_image(
+    im: Image.Image, size: Tuple[int, int], rotate: int = 0, reducing_gap: Optional[float] = THUMBNAIL_REDUCING_GAP
+) -> Image.Image:
     """
-    t = [width, height, ?, jpeg quality, rotate degrees]
+    Return RGB or L mode image, which is scaled to fit in `size` after rotating it `rotate` degrees clockwise.
+    Pass a freshly opened image, because then JPEGs are decoded directly in reduced size
+    (DCT scaling, see Image.draft) and other images are box reduced before the final resampling,
+    so that the result is at least `reducing_gap` times `size`. Bigger gap is sharper and slower,
+    None decodes the full image and resamples it with LANCZOS. `im` may be modified.
     """
-    try:
-        im = Image.open(filepath)
-    except IOError:  # Image file is corrupted
-        logging.warning(f"ERROR in image file: {filepath}")
-        return False
+    CALL_COUNTER["decode"] += 1
+    w, h = size
+    if rotate in (90, 270):
+        w, h = h, w  # Scaling is done before rotating
+    if reducing_gap and im.width > 0 and im.height > 0:
+        # Image.thumbnail() drafts using the whole box, which prevents DCT scaling when aspect ratios differ
+        scale = min(w / im.width, h / im.height, 1.0)
+        im.draft(None, (int(im.width * scale * reducing_gap), int(im.height * scale * reducing_gap)))
+    if im.mode in ("1", "P"):
+        im = im.convert("RGB")  # These modes are resized only with NEAREST
+    im.thumbnail((w, h), Image.Resampling.LANCZOS, reducing_gap=reducing_gap)
     if im.mode not in ("L", "RGB"):
         im = im.convert("RGB")
-    size = (t[0], t[1])
     rotatemap = {
         90: Image.Transpose.ROTATE_270,
         180: Image.Transpose.ROTATE_180,
         270: Image.Transpose.ROTATE_90,
     }
-    if t[4] != 0:
-        im = im.transpose(rotatemap[t[4]])
+    if rotate in rotatemap:
+        im = im.transpose(rotatemap[rotate])
+    return im
+
+
+def downscale_levels(im: Image.Image, sizes: List[int]) -> List[Tuple[int, Image.Image]]:
+    """
+    Return (size, image) tuples, smallest first, where `im` is scaled to fit in size x size boxes.
+    Every level is scaled from the next bigger level instead of `im`, so the work
+    shrinks with every step. Sizes, which would not make the image smaller, are skipped.
+    """
+    levels = []
+    for size in sorted(set(sizes), reverse=True):
+        if max(im.size) <= size:
+            continue
+        im = im.copy()
+        im.thumbnail((size, size), Image.Resampling.LANCZOS)
+        levels.append((size, im))
+    return levels[::-1]
 
-    im.thumbnail(size, Image.Resampling.LANCZOS)
+
+def create_thumbnail(filepath: str, t: list, reducing_gap: Optional[float] = THUMBNAIL_REDUCING_GAP) -> io.BytesIO:
+    """
+    t = [width, height, ?, jpeg quality, rotate degrees]
+    """
+    try:
+        im = Image.open(filepath)
+        im = scale_image(im, (t[0], t[1]), t[4], reducing_gap)
+    except IOError:  # Image file is corrupted
+        logging.warning(f"ERROR in image file: {filepath}")
+        return False
     # Save resized image to a temporary buffer
-    # NOTE: the size will be increased if original is smaller than size
     tmp = io.BytesIO()
     im.save(tmp, "jpeg", quality=t[3])
     tmp.seek(0)
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from content.benchmarks import BENCHMARKS, collect_files
+
+
+class Command(BaseCommand):
+    help = "Run a metadata reading or thumbnailing benchmark for given files"
+
+    def add_arguments(self, parser):
+        parser.add_argument("name", choices=sorted(BENCHMARKS), help="Benchmark to run")
+        parser.add_argument("paths", nargs="+", help="Files or directories to use in the benchmark")
+        parser.add_argument(
+            "--workers", action="store", dest="workers", type=int, default=None, help="Number of worker processes"
+        )
+
+    def handle(self, *args, **options):
+        files = collect_files(options["paths"])
+        if not files:
+            raise CommandError("No files found")
+        kwargs = {}
+        if options["workers"]:
+            kwargs["workers"] = options["workers"]
+        results = BENCHMARKS[options["name"]](files, **kwargs)
+        for key, value in results.items():
+            self.stdout.write(f"{key}: {value}")
@@ -1,23 +1,142 @@
 import logging
 import os
+import tempfile
 
 from django.conf import settings
 from django.core.management.base import BaseCommand  # CommandError
-from django.db.models import Q  # Count, Avg, Max, Min
 
-import content.filetools
-from content.filetools import create_videoinstance, create_audioinstance
-from content.models import Content
-from content.models import Videoinstance, Audioinstance
+from content.batch import Checkpoint, Throughput, run_jobs
+from content.filetools import VIDEO_THUMBNAIL_SEC, transcode
+from content.models import DEDUPLICATE, TRANSCODING_PROFILES, Content, release_file, rendition_cache
+from content.models import Video, Videoinstance, Audioinstance
+from content.profiles import Profile, select_profiles
 
 settings.DEBUG = False  # TODO: remove
 
 log = logging.getLogger("django")
 
 
-def create_instances(limit: int, pk: int, uid: str, redo: bool):
-    qset = Q(mimetype__startswith="video") | Q(mimetype__startswith="audio")
-    contents = Content.objects.filter(qset)
+def save_instance(c: Content, profile: Profile, new_file: str, info: dict, cmd_str: str) -> float:
+    """
+    Save transcoded temporary file `new_file` as an instance of Content `c` and delete it.
+    Return the duration of the instance in seconds.
+    """
+    model = Videoinstance if profile.kind == "video" else Audioinstance
+    inst = model(content=c, command=cmd_str)
+    inst.save()
+    inst.set_file(new_file, profile.ext, profile.name)
+    os.unlink(new_file)
+    # File was copied as is, so metadata probed from the temporary file is valid
+    inst.set_metadata(info)
+    if profile.kind == "audio" and "mimetype" in info:
+        inst.mimetype = info["mimetype"]
+    inst.save()
+    log.debug(f"{inst.mimetype}, {inst.duration}, {getattr(inst, 'width', '')}, {getattr(inst, 'height', '')}")
+    return inst.duration or 0.0
+
+
+def delete_instance(inst):
+    if inst.file and os.path.isfile(inst.file.path):
+        log.debug(f"Deleting old instance {inst.file.path}")
+        release_file(inst.file)
+    inst.delete()
+
+
+def encode_instances(pk: int, names: tuple, redo: bool = False) -> float:
+    """
+    Create video or audio instances of Content `pk` using transcoding profiles `names`.
+    All instances (and the poster thumbnail, if Content has no preview yet) are encoded
+    with a single ffmpeg process, so the source is decoded only once.
+    If `redo` is True, old instances are replaced with the new ones, after they are encoded.
+    Return the total duration of created instances in seconds.
+    Raise RuntimeError if any profile failed, the successful ones are saved anyway.
+    This is run in worker processes when --workers > 1.
+    """
+    c = Content.objects.get(pk=pk)
+    ffp = c.get_probe().ffprobe
+    if ffp.is_video():
+        kind = "video"
+    elif ffp.is_audio():
+        kind = "audio"
+    else:
+        log.warning(f"{c} is not a video or audio file")
+        return 0.0
+    # e.g. video/3gpp Content is actually audio only
+    profiles = [TRANSCODING_PROFILES[name] for name in names if TRANSCODING_PROFILES[name].kind == kind]
+    if not profiles:
+        return 0.0
+    videoinfo = ffp.get_videoinfo() if kind == "video" else {}
+    source_height = videoinfo.get("height")
+    outputs = [(p.kind, p.ffmpeg_params(source_height), p.ext) for p in profiles]
+    poster = None
+    if kind == "video" and not c.preview and hasattr(c, "video"):
+        fd, poster = tempfile.mkstemp(suffix=".jpg")
+        os.close(fd)
+    # Poster is taken at the same time as in Video.generate_thumb()
+    result, results = transcode(c.file.path, outputs, thumbnail=poster, sec=VIDEO_THUMBNAIL_SEC)
+    cmd_str = result.command
+    duration = 0.0
+    failed = []
+    encoded = set()
+    for profile, (new_file, info) in zip(profiles, results):
+        if not info:
+            log.warning(f"ffmpeg {profile.name} instance failed: {cmd_str}")
+            if os.path.isfile(new_file):
+                os.unlink(new_file)
+            failed.append(profile.name)
+            continue
+        encoded.add(profile.name)
+    if redo:
+        # Old instances of failed and skipped (e.g. upscaling) profiles are kept,
+        # instances of profiles removed from the configuration are deleted
+        for inst in list(c.audioinstances.all()) + list(c.videoinstances.all()):
+            if inst.extension in encoded or inst.extension not in TRANSCODING_PROFILES:
+                delete_instance(inst)
+    for profile, (new_file, info) in zip(profiles, results):
+        if profile.name in encoded:
+            duration += save_instance(c, profile, new_file, info, cmd_str)
+    if poster:
+        if c.video.set_thumbnail(poster):
+            c.preview = c.video.thumbnail
+            c.save()
+            c.generate_preview_levels()
+            rendition_cache.invalidate(c.uid)
+        elif os.path.isfile(poster):
+            os.unlink(poster)
+    if failed:
+        raise RuntimeError(f"{c} profiles {', '.join(failed)} failed")
+    return duration
+
+
+def plan_jobs(c: Content, redo: bool) -> list:
+    """
+    Return a (pk, profile names, redo) encoding job for Content `c` in a list. Profiles, which
+    already have an instance are skipped (unless `redo` is True), so an interrupted run
+    continues where it stopped. Video profiles, which would upscale the original, are skipped too.
+    Old instances are replaced in encode_instances(), not here, so nothing is lost if the run is interrupted.
+    """
+    old_instances = [] if redo else list(c.audioinstances.all()) + list(c.videoinstances.all())
+    if DEDUPLICATE and not redo and not old_instances and c.share_instances() > 0:
+        log.info(f"{c} shares instances with an identical Content")
+        return []
+    # Content.mimetype of audio only video/3gpp etc. files is fixed to audio/* in set_file()
+    kind = "video" if c.mimetype.startswith("video") else "audio"
+    source_height = None
+    if kind == "video":
+        try:
+            source_height = c.video.height
+        except Video.DoesNotExist:
+            pass
+    existing = {inst.extension for inst in old_instances}
+    if existing:
+        log.debug(f"{c} has already {len(old_instances)} instances")
+    profiles = select_profiles(TRANSCODING_PROFILES, kind, source_height)
+    names = tuple(p.name for p in profiles if p.name not in existing)
+    return [(c.pk, names, redo)] if names else []
+
+
+def create_instances(limit: int, pk: int, uid: str, redo: bool, workers: int = 1, checkpoint: str = None):
+    contents = Content.objects.filter(mediatype__in=["video", "audio"])
     if uid:
         contents = contents.filter(uid=uid)
     if pk:
@@ -25,74 +144,21 @@ def create_instances(limit: int, pk: int, uid: str, redo: bool):
     contents = contents.order_by("-created")
     if limit > 0:
         contents = contents[:limit]
+    done = Checkpoint(checkpoint)
+    jobs = []
     for c in contents:
+        if c.pk in done:
+            continue
         log.info(f"Preparing to handle {c} (created at {c.created.isoformat()})")
-        old_instances = list(c.audioinstances.all()) + list(c.videoinstances.all())
-        if old_instances:
-            if redo:
-                for inst in old_instances:
-                    if inst.file and os.path.isfile(inst.file.path):
-                        log.debug(f"Deleting old instance {inst.file.path}")
-                        os.unlink(inst.file.path)
-                    inst.delete()
-            else:
-                log.debug(f"{c} has already {len(old_instances)} instances")
-                continue
-        ffp = content.filetools.FFProbe(c.file.path)
-        if ffp.is_video():
-            # scale = "scale=640:trunc(ow/a/2)*2"  # scale width to 640 px
-            scale = "scale=trunc(oh*a/2)*2:360"  # scale height to 360 px (360p)
-            webm_params = ["-acodec", "libvorbis", "-ac", "2", "-ab", "96k", "-ar", "22050", "-vf", scale]
-            mp4_params = ["-vcodec", "libx264", "-preset", "fast", "-vprofile", "baseline", "-vsync", "2"]
-            mp4_params += ["-ab", "64k", "-async", "1", "-f", "mp4", "-vf", scale, "-movflags", "faststart"]
-            params = (
-                ("webm", "video/webm", webm_params),
-                ("mp4", "video/mp4", mp4_params),
-            )
-            for x in params:
-                ext, mimetype, param = x
-                new_video, cmd_str, output = create_videoinstance(c.file.path, param, ext=ext)
-                ffp2 = content.filetools.FFProbe(new_video)
-                info = ffp2.get_videoinfo()
-                if not info:
-                    msg = f"ffmpeg video instance command failed: {cmd_str}"
-                    log.warning(msg)
-                    os.unlink(new_video)
-                    continue
-                vi = Videoinstance(content=c, command=cmd_str)
-                vi.save()
-                vi.set_file(new_video, ext)
-                ffp2 = content.filetools.FFProbe(vi.file.path)
-                info = ffp2.get_videoinfo()
-                vi.set_metadata(info)
-                vi.save()
-                log.debug(f"{vi.mimetype}, {vi.duration}, {vi.width}, {vi.height}")
-        elif ffp.is_audio():
-            params = (
-                ("ogg", "audio/ogg", ["-acodec", "libvorbis", "-ab", "32k"]),
-                ("mp3", "audio/mpeg", ["-acodec", "libmp3lame", "-ab", "64k"]),
-            )
-            for x in params:
-                ext, mimetype, param = x
-                new_video, cmd_str, output = create_audioinstance(c.file.path, param, ext=ext)
-                ffp2 = content.filetools.FFProbe(new_video)
-                info = ffp2.get_audioinfo()
-                if not info:
-                    msg = f"ffmpeg audio instance command failed: {cmd_str}"
-                    log.warning(msg)
-                    os.unlink(new_video)
-                    continue
-
-                ai = Audioinstance(content=c, command=cmd_str)
-                ai.save()
-                ai.set_file(new_video, ext)
-
-                ffp2 = content.filetools.FFProbe(ai.file.path)
-                info = ffp2.get_audioinfo()
-                ai.set_metadata(info)
-                if "mimetype" in info:
-                    ai.mimetype = info["mimetype"]
-                ai.save()
+        jobs += plan_jobs(c, redo)
+    throughput = Throughput(total=len(jobs))
+    for job, duration, err in run_jobs(encode_instances, jobs, workers=workers):
+        if err:
+            log.error(f"Encoding job {job} failed: {err}")
+        else:
+            done.add(job[0])
+        throughput.update(contents=int(err is None), seconds=duration or 0.0, failed=int(err is not None))
+    throughput.report()
 
 
 class Command(BaseCommand):
@@ -118,12 +184,28 @@ class Command(BaseCommand):
         )
         parser.add_argument("--pk", action="store", dest="pk", help="Process only Content with given PK (id)")
         parser.add_argument("--uid", action="store", dest="uid", help="Process only Content with given UID")
+        parser.add_argument(
+            "--workers",
+            action="store",
+            dest="workers",
+            type=int,
+            default=1,
+            help="Number of parallel encoding processes",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            action="store",
+            dest="checkpoint",
+            help="File where finished Contents are saved, an interrupted run is resumed from it",
+        )
 
     def handle(self, *args, **options):
         limit = options.get("limit")
         pk = options.get("pk")
         uid = options.get("uid")
         redo = options.get("redo")
+        workers = options.get("workers")
+        checkpoint = options.get("checkpoint")
         # verbosity = options.get('verbosity')
         # simulate = options.get('simulate')
-        create_instances(limit=limit, pk=pk, uid=uid, redo=redo)
+        create_instances(limit=limit, pk=pk, uid=uid, redo=redo, workers=workers, checkpoint=checkpoint)
@@ -0,0 +1,75 @@
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from content.models import Blob, Content, release_file
+
+log = logging.getLogger("django")
+
+
+def deduplicate_content(original: Content, c: Content):
+    """
+    Make Content `c` share the original file, preview and instances of `original`
+    and delete c's own copies of them.
+    """
+    if c.file.name != original.file.name:
+        release_file(c.file)
+        Blob.share(original.file, original.sha1)
+        c.file.name = original.file.name
+        c.save()
+    if original.preview and c.preview.name != original.preview.name:
+        c.share_preview()
+    old_instances = list(c.videoinstances.all()) + list(c.audioinstances.all())
+    original_instances = list(original.videoinstances.all()) + list(original.audioinstances.all())
+    if original_instances and {i.file.name for i in old_instances} != {i.file.name for i in original_instances}:
+        for inst in old_instances:
+            release_file(inst.file)
+            inst.delete()
+        c.share_instances()
+
+
+def deduplicate(limit: int, dry_run: bool):
+    """
+    Find Contents with identical original files and make them share the same files.
+    This is the migration path for data saved before CONTENT_DEDUPLICATE was enabled.
+    """
+    groups = Content.objects.exclude(sha1=None).exclude(file="").values("sha1", "filesize")
+    groups = groups.annotate(cnt=Count("id")).filter(cnt__gt=1).order_by("-cnt")
+    if limit > 0:
+        groups = groups[:limit]
+    contents_cnt = bytes_cnt = 0
+    for group in groups:
+        contents = Content.objects.filter(sha1=group["sha1"], filesize=group["filesize"]).exclude(file="")
+        contents = list(contents.order_by("id"))
+        original = contents[0]
+        for c in contents[1:]:
+            if c.file.name == original.file.name:
+                continue  # Already shared
+            log.info(f"{c} is a duplicate of {original}")
+            contents_cnt += 1
+            bytes_cnt += c.filesize or 0
+            if not dry_run:
+                deduplicate_content(original, c)
+    log.info(f"Deduplicated {contents_cnt} Contents, {bytes_cnt} bytes of original files")
+    return contents_cnt, bytes_cnt
+
+
+class Command(BaseCommand):
+    help = "Make Contents with identical original files share original, preview and instance files"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--limit", action="store", dest="limit", type=int, default=0, help="Limit the number of sha1s to handle"
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            dest="dry_run",
+            default=False,
+            help="Only report duplicates, do not change anything",
+        )
+
+    def handle(self, *args, **options):
+        contents_cnt, bytes_cnt = deduplicate(limit=options.get("limit"), dry_run=options.get("dry_run"))
+        self.stdout.write(f"{contents_cnt} duplicate Contents, {bytes_cnt} bytes of original files")
@@ -2,6 +2,8 @@
 from __future__ import unicode_literals
 
 import imaplib
+import re
+import tempfile
 from optparse import make_option
 from django.conf import settings
 from django.core.management.base import BaseCommand
@@ -13,6 +15,9 @@ import logging
 
 log = logging.getLogger("fetch_mail")
 
+# Messages are fetched in parts of this size, so a large mail is never fully in memory
+FETCH_CHUNK_SIZE = getattr(settings, "CONTENT_MAIL_FETCH_CHUNK_SIZE", 4 * 1024 * 1024)
+
 
 def imap_connect(host):
     try:
@@ -28,20 +33,42 @@ def imap_disconnect(M):
     M.logout()
 
 
+def fetch_message_to_file(M, msgnum, f, chunk_size=FETCH_CHUNK_SIZE):
+    """
+    Write message `msgnum` to file handle `f` using partial BODY[]<offset.length> fetches.
+    Return IMAP response type of the last fetch.
+    """
+    typ, data = M.fetch(msgnum, "(RFC822.SIZE)")
+    if typ != "OK":
+        return typ
+    size = int(re.search(rb"RFC822\.SIZE (\d+)", data[0]).group(1))
+    offset = 0
+    while offset < size:
+        typ, data = M.fetch(msgnum, "(BODY.PEEK[]<%d.%d>)" % (offset, chunk_size))
+        if typ != "OK" or not isinstance(data[0], tuple) or not data[0][1]:
+            break
+        f.write(data[0][1])
+        offset += len(data[0][1])
+    if offset < size:
+        log.error("Fetched only %d of %d bytes of mail %s" % (offset, size, msgnum))
+        return "NO"
+    return typ
+
+
 def fetch_message(M, msgnum, delete_msg=True):
     log.info("Starting to fetch mail %s" % msgnum)
-    typ, data = M.fetch(msgnum, "(RFC822)")
-    log.info("Fetch done: %s. Saving message as a Mail object." % typ)
-    mailfiledata = data[0][1]
-    mail = Mail()
-    mail.set_file(mailfiledata, M.host)
+    with tempfile.TemporaryFile() as f:
+        typ = fetch_message_to_file(M, msgnum, f)
+        log.info("Fetch done: %s. Saving message as a Mail object." % typ)
+        if typ != "OK":
+            log.info("Status %s" % typ)
+            return None
+        mail = Mail()
+        mail.set_file(f, M.host)
     log.info("Save done")
-    if typ == "OK":
-        log.info("Status ok. Setting Deleted FLAGS: %s" % delete_msg)
-        if delete_msg:
-            M.store(msgnum, "+FLAGS", "\\Deleted")
-    else:
-        log.info("Status %s" % typ)
+    log.info("Status ok. Setting Deleted FLAGS: %s" % delete_msg)
+    if delete_msg:
+        M.store(msgnum, "+FLAGS", "\\Deleted")
     return mail
 
 
@@ -0,0 +1,172 @@
+import datetime
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.timezone import make_aware
+
+from content.batch import Checkpoint, Throughput, run_jobs
+from content.filetools import MEDIATYPES
+from content.models import Content, thumbnail_postfix
+
+log = logging.getLogger("django")
+
+# Mediatypes and mimetypes which have a preview, see Content.generate_thumbnail()
+PREVIEW_MIMETYPES = ["image", "video", "application/pdf"]
+
+
+def regenerate_preview(pk: int, force: bool = False) -> bool:
+    """
+    Generate Content's preview and its smaller levels again.
+    With `force` the preview is rendered, not shared from an identical Content.
+    Return True if the Content has a preview afterwards.
+    This is run in worker processes when --workers > 1.
+    """
+    c = Content.objects.get(pk=pk)
+    c.generate_thumbnail(share=not force)
+    return bool(c.preview)
+
+
+def parse_time(value: str) -> datetime.datetime:
+    """
+    Parse '2022-04-23' or '2022-04-23T13:41:00' to an aware datetime.
+    """
+    dt = parse_datetime(value)
+    if dt is None:
+        d = parse_date(value)
+        if d is None:
+            raise CommandError(f"Invalid date: {value}")
+        dt = datetime.datetime.combine(d, datetime.time())
+    return make_aware(dt) if dt.tzinfo is None else dt
+
+
+def select_contents(
+    mimetypes: list, since: str = None, until: str = None, min_id: int = None, max_id: int = None, limit: int = 0
+):
+    qset = Q()
+    for mimetype in mimetypes or PREVIEW_MIMETYPES:
+        if mimetype in MEDIATYPES:  # Use the indexed mediatype instead of a prefix match
+            qset |= Q(mediatype=mimetype)
+        else:
+            qset |= Q(mimetype__startswith=mimetype)
+    contents = Content.objects.filter(qset).exclude(file="")
+    if since:
+        contents = contents.filter(created__gte=parse_time(since))
+    if until:
+        contents = contents.filter(created__lt=parse_time(until))
+    if min_id:
+        contents = contents.filter(pk__gte=min_id)
+    if max_id:
+        contents = contents.filter(pk__lte=max_id)
+    contents = contents.order_by("pk")
+    if limit > 0:
+        contents = contents[:limit]
+    return contents
+
+
+def regenerate_previews(
+    mimetypes: list = None,
+    since: str = None,
+    until: str = None,
+    min_id: int = None,
+    max_id: int = None,
+    limit: int = 0,
+    force: bool = False,
+    dry_run: bool = False,
+    workers: int = 1,
+    checkpoint: str = None,
+) -> tuple:
+    """
+    Regenerate previews, which were not generated with current THUMBNAIL_PARAMETERS
+    (or all selected previews if `force` is True). Return the number of regenerated
+    and skipped Contents.
+    """
+    done = Checkpoint(checkpoint)
+    contents = select_contents(mimetypes, since, until, min_id, max_id, limit)
+    jobs = []
+    skipped = 0
+    # Only the fields needed for the up to date check are loaded, previews are generated in workers
+    for c in contents.only("pk", "preview").iterator(chunk_size=2000):
+        if c.pk in done or (not force and c.preview_is_up_to_date()):
+            skipped += 1
+            continue
+        jobs.append((c.pk, force))
+    log.info(f"{len(jobs)} previews to regenerate with {thumbnail_postfix()}, {skipped} skipped")
+    if dry_run:
+        return len(jobs), skipped
+    throughput = Throughput(total=len(jobs))
+    for job, has_preview, err in run_jobs(regenerate_preview, jobs, workers=workers):
+        if err:
+            log.error(f"Regenerating preview of Content {job[0]} failed: {err}")
+        else:
+            done.add(job[0])
+            if not has_preview:
+                log.warning(f"Content {job[0]} has no preview after regenerating it")
+        throughput.update(contents=int(err is None), failed=int(err is not None))
+    throughput.report()
+    return len(jobs), skipped
+
+
+class Command(BaseCommand):
+    help = "Regenerate previews of images, videos and PDFs, which are not up to date with CONTENT_THUMBNAIL_PARAMETERS"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--mimetype",
+            action="append",
+            dest="mimetypes",
+            help="Handle only Contents of this mediatype (e.g. image) or whose mimetype starts with this "
+            "(e.g. image/jpeg), can be repeated",
+        )
+        parser.add_argument("--since", action="store", dest="since", help="Handle Contents created at or after this")
+        parser.add_argument("--until", action="store", dest="until", help="Handle Contents created before this")
+        parser.add_argument("--min-id", action="store", dest="min_id", type=int, help="Smallest Content id to handle")
+        parser.add_argument("--max-id", action="store", dest="max_id", type=int, help="Largest Content id to handle")
+        parser.add_argument(
+            "--limit", action="store", dest="limit", type=int, default=0, help="Limit the number of contents to handle"
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            dest="force",
+            default=False,
+            help="Regenerate also previews, which are up to date",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            dest="dry_run",
+            default=False,
+            help="Only report how many previews would be regenerated",
+        )
+        parser.add_argument(
+            "--workers",
+            action="store",
+            dest="workers",
+            type=int,
+            default=1,
+            help="Number of parallel processes",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            action="store",
+            dest="checkpoint",
+            help="File where finished Contents are saved, an interrupted run is resumed from it",
+        )
+
+    def handle(self, *args, **options):
+        regenerated, skipped = regenerate_previews(
+            mimetypes=options.get("mimetypes"),
+            since=options.get("since"),
+            until=options.get("until"),
+            min_id=options.get("min_id"),
+            max_id=options.get("max_id"),
+            limit=options.get("limit"),
+            force=options.get("force"),
+            dry_run=options.get("dry_run"),
+            workers=options.get("workers"),
+            checkpoint=options.get("checkpoint"),
+        )
+        verb = "Would regenerate" if options.get("dry_run") else "Regenerated"
+        self.stdout.write(f"{verb} {regenerated} previews, {skipped} skipped")
@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('content', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='content',
+            name='sha1',
+            field=models.CharField(db_index=True, editable=False, max_length=40, null=True),
+        ),
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('storage', models.CharField(editable=False, max_length=16)),
+                ('name', models.CharField(editable=False, max_length=500)),
+                ('sha1', models.CharField(db_index=True, editable=False, max_length=40)),
+                ('refcount', models.IntegerField(default=1, editable=False)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='blob',
+            constraint=models.UniqueConstraint(fields=('storage', 'name'), name='unique_blob_storage_name'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+from django.db import migrations, models
+
+
+def mark_duplicate_mails(apps, schema_editor):
+    # Concurrent fetchers may have saved the same mail twice, keep the oldest one
+    Mail = apps.get_model('content', 'Mail')
+    seen = set()
+    for mail in Mail.objects.exclude(status='DUPLICATE').order_by('id').only('id', 'md5', 'sha1').iterator():
+        key = (mail.md5, mail.sha1)
+        if key in seen:
+            Mail.objects.filter(pk=mail.pk).update(status='DUPLICATE')
+        seen.add(key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('content', '0002_blob_content_sha1_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mail',
+            name='md5',
+            field=models.CharField(db_index=True, editable=False, max_length=32, null=True),
+        ),
+        migrations.AlterField(
+            model_name='mail',
+            name='sha1',
+            field=models.CharField(db_index=True, editable=False, max_length=40, null=True),
+        ),
+        migrations.RunPython(mark_duplicate_mails, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='mail',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'DUPLICATE'), _negated=True), fields=('md5', 'sha1'), name='unique_mail_hashes'),
+        ),
+    ]
@@ -0,0 +1,62 @@
+from django.db import migrations, models, transaction
+from django.db.models import Case, Q, Value, When
+
+BATCH_SIZE = 10000
+
+
+def backfill_mediatype(apps, schema_editor):
+    # Same rules as filetools.get_mediatype(), copied here so later changes don't alter this migration
+    Content = apps.get_model('content', 'Content')
+    mediatype = Case(
+        When(mimetype__startswith='image/', then=Value('image')),
+        When(mimetype__startswith='video/', then=Value('video')),
+        When(mimetype__startswith='audio/', then=Value('audio')),
+        When(
+            Q(mimetype__in=[
+                'application/pdf',
+                'application/rtf',
+                'application/msword',
+                'application/vnd.ms-excel',
+                'application/vnd.ms-powerpoint',
+            ])
+            | Q(mimetype__startswith='text/')
+            | Q(mimetype__startswith='application/vnd.openxmlformats-officedocument.')
+            | Q(mimetype__startswith='application/vnd.oasis.opendocument.'),
+            then=Value('document'),
+        ),
+        default=Value('other'),
+    )
+    last = Content.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    # Every batch is committed separately (atomic = False), so the table is not locked for the whole backfill
+    for start in range(0, last + 1, BATCH_SIZE):
+        with transaction.atomic():
+            Content.objects.filter(id__gte=start, id__lt=start + BATCH_SIZE, mediatype__isnull=True).update(
+                mediatype=mediatype
+            )
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('content', '0004_content_list_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='content',
+            name='mediatype',
+            field=models.CharField(choices=[('image', 'image'), ('video', 'video'), ('audio', 'audio'), ('document', 'document'), ('other', 'other')], editable=False, max_length=16, null=True),
+        ),
+        migrations.RunPython(backfill_mediatype, migrations.RunPython.noop),
+        # Indexes are built after the backfill, which is faster than updating them row by row
+        migrations.AddIndex(
+            model_name='content',
+            index=models.Index(fields=['mediatype', '-created'], name='content_mediatype_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='content',
+            index=models.Index(fields=['mediatype', 'status', '-created'], name='content_mediatype_status_idx'),
+        ),
+    ]
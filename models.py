@@ -9,12 +9,12 @@ about duration, bitrate, dimensions etc.
 # TODO: make Geo features optional, e.g. create conditional point field
 from __future__ import annotations
 
-import hashlib
 import io
 import logging
 import mimetypes
 import os
 import random
+import re
 import string
 import tempfile
 
@@ -30,13 +30,19 @@ from django.core.files import File
 from django.core.files.base import ContentFile
 from django.core.files.storage import FileSystemStorage
 from django.core.files.uploadedfile import UploadedFile
+from django.db import IntegrityError, transaction
 from django.db.models import Manager  # https://stackoverflow.com/a/48894881
 from django.utils.translation import gettext_lazy as _
-from pillow_heif import register_heif_opener
+from PIL import features
+from pillow_heif import libheif_info, register_avif_opener, register_heif_opener
 
 import content.filetools as filetools
 from content.filetools import do_video_thumbnail
 from content.filetools import get_mimetype, do_pdf_thumbnail
+from content.probecache import ProbeCache
+from content.probepool import ProbePool
+from content.profiles import configured_profiles
+from content.renditions import RenditionCache
 
 # Original files are saved in content_storage
 content_storage = FileSystemStorage(location=settings.APP_DATA_DIRS["CONTENT"])
@@ -46,6 +52,13 @@ video_storage = FileSystemStorage(location=settings.APP_VAR_DIRS["VIDEO"])
 audio_storage = FileSystemStorage(location=settings.APP_VAR_DIRS["AUDIO"])
 # TODO: change to APP_VAR_DIRS or something
 mail_storage = FileSystemStorage(location=settings.MAIL_CONTENT_DIR)
+# Storages whose files may be shared between Contents, see Blob
+STORAGES = {
+    "content": content_storage,
+    "preview": preview_storage,
+    "video": video_storage,
+    "audio": audio_storage,
+}
 
 # define this in local_settings, if you want to change this
 # TODO: replace with getattr
@@ -53,10 +66,40 @@ try:
     THUMBNAIL_PARAMETERS = settings.CONTENT_THUMBNAIL_PARAMETERS
 except Exception:  # noqa
     THUMBNAIL_PARAMETERS = (1600, 1600, "JPEG", 90)  # w, h, format, quality
+# Smaller preview levels saved next to Content.preview, views.preview scales the nearest bigger one
+PREVIEW_SIZES = sorted(getattr(settings, "CONTENT_PREVIEW_SIZES", [160, 320, 640]))
+# Quality of downscaling in thumbnail generation, see filetools.scale_image()
+THUMBNAIL_REDUCING_GAP = getattr(settings, "CONTENT_THUMBNAIL_REDUCING_GAP", filetools.THUMBNAIL_REDUCING_GAP)
+
+# Video and audio instance profiles, see content.profiles
+TRANSCODING_PROFILES = configured_profiles()
+# If True, Contents with identical original files share the same original, preview and instance files
+DEDUPLICATE = getattr(settings, "CONTENT_DEDUPLICATE", False)
+# If True, uploaded files are only saved in request and processed in a Celery task
+ASYNC_INGEST = getattr(settings, "CONTENT_ASYNC_INGEST", False)
+# Timeouts and resource limits of ffmpeg, ffprobe and convert, see filetools.RUNNER_LIMITS
+filetools.configure_runner(**getattr(settings, "CONTENT_RUNNER_LIMITS", {}))
+# Max size of resized preview cache in bytes, 0 disables the cache
+RENDITION_CACHE_MAX_SIZE = getattr(settings, "CONTENT_RENDITION_CACHE_MAX_SIZE", 1024**3)
+rendition_cache = RenditionCache(preview_storage.path("renditions"), RENDITION_CACHE_MAX_SIZE)
+# Max number of cached ffprobe results, 0 disables the cache
+PROBE_CACHE_MAX_ENTRIES = getattr(settings, "CONTENT_PROBE_CACHE_MAX_ENTRIES", 100000)
+filetools.FFProbe.cache = ProbeCache(preview_storage.path("probecache.sqlite3"), PROBE_CACHE_MAX_ENTRIES)
+# Number of pre-warmed worker processes for probing files and PDF thumbnails, 0 runs them in this process
+PROBE_POOL_WORKERS = getattr(settings, "CONTENT_PROBE_POOL_WORKERS", 0)
+if PROBE_POOL_WORKERS:
+    filetools.FileProbe.pool = ProbePool(PROBE_POOL_WORKERS)  # Workers are started on first use
 
 CONTENT_PRIVACY_CHOICES = (("PRIVATE", _("Private")), ("RESTRICTED", _("Group")), ("PUBLIC", _("Public")))
 
 register_heif_opener()
+register_avif_opener()
+# Image formats PIL can save in this installation, see views.preview
+AVAILABLE_FORMATS = {"jpeg", "png"}
+if features.check("webp"):
+    AVAILABLE_FORMATS.add("webp")
+if libheif_info().get("AVIF"):
+    AVAILABLE_FORMATS.add("avif")
 
 
 def upload_split_by_1000(obj, filename):
@@ -83,6 +126,79 @@ def upload_split_by_1000(obj, filename):
     return path
 
 
+class HashingFile(File):
+    """
+    File wrapper, which feeds every chunk the storage reads to a StreamHasher.
+    NOTE: temporary_file_path() of the wrapped file is hidden, so TemporaryUploadedFiles
+    are not wrapped (see Content.save_file) and FileSystemStorage can move them.
+    """
+
+    def __init__(self, file, hasher: filetools.StreamHasher, name: str = None):
+        super().__init__(file, name)
+        self.hasher = hasher
+
+    def chunks(self, chunk_size: int = None):
+        for chunk in super().chunks(chunk_size):
+            self.hasher.update(chunk)
+            yield chunk
+
+
+def release_file(fieldfile):
+    """
+    Delete the file of a FieldFile, unless it is still shared with other Contents (see Blob).
+    In both cases the FieldFile is emptied.
+    """
+    if not fieldfile:
+        return
+    if Blob.release(fieldfile) > 0:
+        fieldfile.name = None
+        setattr(fieldfile.instance, fieldfile.field.attname, None)
+    else:
+        if fieldfile.storage is preview_storage:
+            delete_preview_levels(fieldfile.name)
+        fieldfile.delete(save=False)
+
+
+def thumbnail_postfix(t: tuple = THUMBNAIL_PARAMETERS) -> str:
+    """
+    Return thumbnail parameters as they are encoded in preview filenames, e.g. '1600-1600-JPEGx90'
+    """
+    return "{}-{}-{}x{}".format(t[0], t[1], t[2], t[3])
+
+
+def preview_level_name(name: str, size: int) -> str:
+    """
+    Return the name of preview `name` scaled to fit in size x size box,
+    e.g. '000/000/000000001-abc-1600-1600-JPEGx90.320.jpg'
+    """
+    root, ext = os.path.splitext(name)
+    return f"{root}.{size}{ext}"
+
+
+def save_preview_levels(name: str, im: PIL.Image.Image):
+    """
+    Scale preview image `im` to PREVIEW_SIZES and save levels next to preview file `name`.
+    """
+    fmt = "PNG" if name.lower().endswith(".png") else "JPEG"
+    for size, level in filetools.downscale_levels(im, PREVIEW_SIZES):
+        tmp = io.BytesIO()
+        if fmt == "JPEG":
+            level.save(tmp, fmt, quality=THUMBNAIL_PARAMETERS[3])
+        else:
+            level.save(tmp, fmt)
+        level_name = preview_level_name(name, size)
+        if preview_storage.exists(level_name):
+            preview_storage.delete(level_name)
+        preview_storage.save(level_name, ContentFile(tmp.getvalue()))
+
+
+def delete_preview_levels(name: str):
+    for size in PREVIEW_SIZES:
+        level_name = preview_level_name(name, size)
+        if preview_storage.exists(level_name):
+            preview_storage.delete(level_name)
+
+
 def get_uid(length=12):
     """
     Generate and return a random string which can be considered unique.
@@ -111,7 +227,7 @@ class Content(models.Model):
     Common fields for all content files.
 
     Field info:
-    status -
+    status - UNPROCESSED, PROCESSING, PROCESSED, INVALID, FAILED or DELETED
     privacy - PRIVATE, RESTRICTED, PUBLIC
     uid - unique random identifier string
     user - Django User, if relevant
@@ -120,6 +236,7 @@ class Content(models.Model):
     filesize - file size of original file in bytes
     filetime - creation time of original file (e.g. EXIF timestamp)
     mimetype - Official MIME Media Type (e.g. image/jpeg, video/mp4)
+    mediatype - image, video, audio, document or other, derived from mimetype
     file - original file object
     preview - thumbnail object if relevant
     md5 - md5 of original file in hex-format
@@ -155,10 +272,13 @@ class Content(models.Model):
     filesize = models.IntegerField(null=True, editable=False)
     filetime = models.DateTimeField(blank=True, null=True, editable=False)
     mimetype = models.CharField(max_length=200, null=True, editable=False)
+    mediatype = models.CharField(
+        max_length=16, null=True, editable=False, choices=[(m, m) for m in filetools.MEDIATYPES]
+    )
     file = models.FileField(storage=content_storage, upload_to=upload_split_by_1000)  # , editable=False)
     preview = models.ImageField(storage=preview_storage, blank=True, upload_to=upload_split_by_1000, editable=False)
     md5 = models.CharField(max_length=32, null=True, editable=False)
-    sha1 = models.CharField(max_length=40, null=True, editable=False)
+    sha1 = models.CharField(max_length=40, null=True, db_index=True, editable=False)
 
     # license
     # origin, e.g. City museum, John Smith's photo album
@@ -192,6 +312,19 @@ class Content(models.Model):
 
     objects = Manager()
 
+    class Meta:
+        # Indexes for the list API, see content.pagination and views.filter_contents
+        indexes = [
+            models.Index(fields=["-created", "-id"], name="content_created_id_idx"),
+            models.Index(fields=["status", "-created"], name="content_status_created_idx"),
+            models.Index(fields=["privacy", "-created"], name="content_privacy_created_idx"),
+            models.Index(fields=["user", "-created"], name="content_user_created_idx"),
+            # varchar_pattern_ops makes mimetype__startswith (LIKE 'video/%') use the index
+            models.Index(fields=["mimetype"], name="content_mimetype_like_idx", opclasses=["varchar_pattern_ops"]),
+            models.Index(fields=["mediatype", "-created"], name="content_mediatype_created_idx"),
+            models.Index(fields=["mediatype", "status", "-created"], name="content_mediatype_status_idx"),
+        ]
+
     # TODO: replace this with property stuff
     def latlon(self):
         # FIXME: should this be lonlat?
@@ -202,32 +335,126 @@ class Content(models.Model):
         self.point = p
         self.point_geom = p
 
-    def save_file(self, originalfilename: str, filecontent: UploadedFile | io.IOBase | str):
+    def save_file(self, originalfilename: str, filecontent: UploadedFile | io.IOBase | str, mimetype: str = None):
         """
         Save filecontent to the filesystem and fill filename, filesize fields.
+        md5 and sha1 are calculated while the file is being written.
         filecontent may be
         - open file handle (opened in "rb"-mode)
         - existing file name (full path)
         - raw file data
+        libmagic is not run if `mimetype` is given.
         """
-        # TODO: check functionality with very large files
         self.originalfilename = os.path.basename(originalfilename)
         self.save()  # Must save here to get self.id
         root, ext = os.path.splitext(originalfilename)
         filename = "{:09d}-{}{}".format(self.id, self.uid, ext.lower())
-        if isinstance(filecontent, UploadedFile):  # Is an open file
-            self.file.save(filename, File(filecontent))
-        elif isinstance(filecontent, io.IOBase):  # Is open file
-            self.file.save(filename, File(filecontent))
+        hasher = filetools.StreamHasher()
+        if hasattr(filecontent, "temporary_file_path"):  # Is a large upload, e.g. TemporaryUploadedFile
+            # Hash it in place, so FileSystemStorage moves the temporary file instead of copying it
+            with open(filecontent.temporary_file_path(), "rb") as f:
+                for chunk in File(f).chunks():
+                    hasher.update(chunk)
+            self.file.save(filename, filecontent)
+        elif isinstance(filecontent, (UploadedFile, io.IOBase)):  # Is an open file
+            self.file.save(filename, HashingFile(filecontent, hasher))
         elif len(filecontent) < 1000 and os.path.isfile(filecontent):
             # Is existing file in file system
             with open(filecontent, "rb") as f:
-                self.file.save(filename, File(f))
+                self.file.save(filename, HashingFile(f, hasher))
         else:  # Is just something in the memory
-            self.file.save(filename, ContentFile(filecontent))
+            if isinstance(filecontent, str):
+                filecontent = filecontent.encode()
+            self.file.save(filename, HashingFile(io.BytesIO(filecontent), hasher))
         self.filesize = self.file.size
+        if hasher.size == self.filesize:
+            self.md5, self.sha1 = hasher.hexdigests()
+            if DEDUPLICATE:
+                self.deduplicate()
+            if not mimetype:
+                mimetype = filetools.get_mimetype_from_buffer(hasher.head)
+            self._probe = filetools.FileProbe(self.file.path, mimetype=mimetype, sha1=self.sha1)
+        else:  # Storage didn't read the file using chunks(), set_filemeta() will calculate hashes
+            self.md5 = self.sha1 = None
         self.save()
 
+    def find_duplicate(self) -> Content | None:
+        """
+        Return the oldest other Content, which has an identical original file.
+        """
+        if not self.sha1:
+            return None
+        duplicates = Content.objects.filter(sha1=self.sha1, filesize=self.filesize).exclude(pk=self.pk)
+        return duplicates.exclude(file="").order_by("id").first()
+
+    def deduplicate(self) -> bool:
+        """
+        If another Content has an identical original file, delete
+        the just saved copy and share the other Content's file instead.
+        """
+        original = self.find_duplicate()
+        if original is None or not original.file.storage.exists(original.file.name):
+            return False
+        Blob.share(original.file, self.sha1)
+        self.file.storage.delete(self.file.name)
+        self.file.name = original.file.name
+        self.save()
+        return True
+
+    def share_preview(self) -> bool:
+        """
+        Use the preview of an identical Content instead of generating a new one.
+        """
+        original = self.find_duplicate()
+        if original is None or not original.preview or not original.preview_is_up_to_date():
+            return False
+        if self.preview and self.preview.name == original.preview.name:
+            return True  # Already shared, another Blob.share() would leak a reference
+        thumbnail_objs = []
+        if self.mimetype.startswith("image"):
+            try:
+                if original.image.rotate != self.image.rotate:
+                    return False
+                thumbnail_objs.append(self.image)
+            except Image.DoesNotExist:
+                return False
+        elif self.mimetype.startswith("video"):
+            try:
+                thumbnail_objs.append(self.video)
+            except Video.DoesNotExist:
+                pass
+        # Release possible old previews, image/video thumbnail has often the same file as preview
+        released = {original.preview.name}
+        for f in [self.preview] + [obj.thumbnail for obj in thumbnail_objs]:
+            if f and f.name not in released:
+                released.add(f.name)
+                release_file(f)
+        Blob.share(original.preview, self.sha1)
+        self.preview.name = original.preview.name
+        for obj in thumbnail_objs:
+            obj.thumbnail.name = original.preview.name
+            obj.save()
+        self.save()
+        return True
+
+    def share_instances(self) -> int:
+        """
+        Share video and audio instances of an identical Content.
+        Return the number of shared instances.
+        """
+        original = self.find_duplicate()
+        if original is None:
+            return 0
+        cnt = 0
+        for inst in list(original.videoinstances.all()) + list(original.audioinstances.all()):
+            Blob.share(inst.file, self.sha1)
+            inst.pk = None  # Save a copy, which refers to the same file
+            inst._state.adding = True
+            inst.content = self
+            inst.save()
+            cnt += 1
+        return cnt
+
     def set_file(
         self,
         originalfilename: str,
@@ -244,19 +471,51 @@ class Content(models.Model):
         - existing file name (full path)
         - raw file data
         """
-        self.save_file(originalfilename, filecontent)
-        if md5 is None or sha1 is None:
+        self.save_file(originalfilename, filecontent, mimetype)
+        self.set_filemeta(mimetype, md5, sha1)
+        self.status = "PROCESSED"
+        self.save()
+
+    def set_filemeta(self, mimetype: str = None, md5: str = None, sha1: str = None):
+        """
+        Fill mimetype, mediatype, md5 and sha1 fields of already saved Content.file.
+        """
+        if md5 is not None and sha1 is not None:
+            self.md5, self.sha1 = md5, sha1
+        elif self.md5 is None or self.sha1 is None:  # Not calculated in save_file()
             self.md5, self.sha1 = filetools.hashfile(self.file.path)
         if mimetype:
             self.mimetype = mimetype
         else:
-            info = filetools.fileinfo(self.file.path)
+            info = self.get_probe().fileinfo()
             mime = info["mimetype"]
             if mime:
                 self.mimetype = mime
             else:
-                self.mimetype = mimetypes.guess_type(originalfilename)[0]
-        self.status = "PROCESSED"
+                self.mimetype = mimetypes.guess_type(self.originalfilename)[0]
+        self.mediatype = filetools.get_mediatype(self.mimetype)
+        self.save()
+
+    def process(self):
+        """
+        Extract metadata and generate thumbnail for a Content, whose file
+        has been saved with save_file() only. This is run in the background
+        when CONTENT_ASYNC_INGEST is enabled, see tasks.process_content_task.
+        """
+        self.status = "PROCESSING"
+        self.save()
+        try:
+            self.set_filemeta()
+            self.set_fileinfo()
+            self.generate_thumbnail()
+        except Exception as err:
+            logging.exception(f"Failed to process Content {self.uid}: {err}")
+            self.status = "FAILED"
+            self.save()
+            raise
+        # Image.save() may have flagged broken image files INVALID
+        if self.status != "INVALID":
+            self.status = "PROCESSED"
         self.save()
 
     def set_fileinfo(self, mime: str = None):
@@ -268,21 +527,19 @@ class Content(models.Model):
             mime = self.mimetype
         obj = info = None
         if mime.startswith("image"):
-            info = filetools.get_imageinfo(self.file.path)
+            info = self.get_probe().imageinfo
             try:
                 obj = self.image
             except Image.DoesNotExist:
                 obj = Image(content=self)
         elif mime.startswith("video"):
-            ffp = filetools.FFProbe(self.file.path)
-            info = ffp.get_videoinfo()
+            info = self.get_probe().ffprobe.get_videoinfo()
             try:
                 obj = self.video
             except Video.DoesNotExist:
                 obj = Video(content=self)
         elif mime.startswith("audio"):
-            ffp = filetools.FFProbe(self.file.path)
-            info = ffp.get_audioinfo()
+            info = self.get_probe().ffprobe.get_audioinfo()
             try:
                 obj = self.audio
             except Audio.DoesNotExist:
@@ -303,49 +560,120 @@ class Content(models.Model):
             return obj
 
     def get_fileinfo(self):
-        info = filetools.get_imageinfo(self.file.path)
+        info = self.get_probe().imageinfo
         return info
 
-    def generate_thumbnail(self):
+    def get_probe(self) -> filetools.FileProbe:
+        """
+        Return FileProbe of Content.file. The same probe is reused
+        for the same file, so every external tool is run only once per file.
+        """
+        probe = getattr(self, "_probe", None)
+        if probe is None or probe.path != self.file.path:
+            probe = self._probe = filetools.FileProbe(self.file.path, sha1=self.sha1)
+        return probe
+
+    def generate_thumbnail(self, share: bool = True):
         """
         Generates the file to preview field for Videos, Images and PDFs.
+        If `share` is False, the preview is rendered even if an identical Content has one.
         TODO: use only content.preview for thumbnails, not video/image.thumbnail
         """
         # TODO: create generic thumbnail functions for video, image and pdf
+        rendition_cache.invalidate(self.uid)
+        if DEDUPLICATE and share and self.share_preview():
+            return None
         if self.mimetype.startswith("image"):
             try:
                 im = PIL.Image.open(self.file.path)
-                self.image.generate_thumb(im, self.image.thumbnail, THUMBNAIL_PARAMETERS)
+                thumb = self.image.generate_thumb(im, self.image.thumbnail, THUMBNAIL_PARAMETERS)
                 if self.image.thumbnail:
                     self.preview = self.image.thumbnail
                     self.save()
+                    self.generate_preview_levels(thumb or None)
             except Image.DoesNotExist:
                 pass
         elif self.mimetype.startswith("video"):
             try:
                 if self.video.thumbnail:
-                    self.video.thumbnail.delete()
+                    release_file(self.video.thumbnail)
                 self.video.generate_thumb()
                 if self.video.thumbnail:
                     self.preview = self.video.thumbnail
                     self.save()
+                    self.generate_preview_levels()
             except Video.DoesNotExist:
                 pass
         elif self.mimetype.startswith("application/pdf"):
             fd, tmp_name = tempfile.mkstemp()  # Remember to close fd!
             tmp_name += ".png"
-            if do_pdf_thumbnail(self.file.path, tmp_name):
-                postfix = "{}-{}-{}x{}".format(THUMBNAIL_PARAMETERS)  # noqa
+            pool = filetools.FileProbe.pool
+            created = (
+                pool.pdf_thumbnail(self.file.path, tmp_name) if pool else do_pdf_thumbnail(self.file.path, tmp_name)
+            )
+            if created:
+                postfix = thumbnail_postfix(THUMBNAIL_PARAMETERS)
                 filename = "{:09d}-{}-{}.png".format(self.id, self.uid, postfix)
                 if os.path.isfile(tmp_name):
+                    release_file(self.preview)  # Delete possible previous version
                     with open(tmp_name, "rb") as f:
                         self.preview.save(filename, File(f))
                     self.save()
                     os.unlink(tmp_name)
+                    self.generate_preview_levels()
             os.close(fd)
         else:
             return None
 
+    def generate_preview_levels(self, im: PIL.Image.Image = None):
+        """
+        Save smaller versions of Content.preview (see PREVIEW_SIZES) next to it.
+        `im` is the preview image, if it is already decoded.
+        """
+        if not self.preview:
+            return
+        try:
+            if im is None:
+                im = PIL.Image.open(self.preview.path)
+                im.load()
+                filetools.CALL_COUNTER["decode"] += 1
+            save_preview_levels(self.preview.name, im)
+        except IOError as err:
+            logging.warning(f"Failed to generate preview levels for {self}: {err}")
+
+    def preview_is_up_to_date(self) -> bool:
+        """
+        Return True if Content.preview was generated with current THUMBNAIL_PARAMETERS.
+        """
+        if not self.preview:
+            return False
+        root, ext = os.path.splitext(os.path.basename(self.preview.name))
+        # Storage may have added a random suffix like '_AbCdEf1' to the name
+        return re.search(r"-{}(_\w+)?$".format(re.escape(thumbnail_postfix())), root) is not None
+
+    def get_preview_level(self, width: int, height: int, crop: bool = False) -> str | None:
+        """
+        Return path of the smallest saved preview level, which doesn't need to be upscaled
+        to fill width x height (`crop`) or to fit in it, or Content.preview's own path.
+        Return None if there is no preview.
+        """
+        thumbnail = self.preview
+        if not thumbnail:
+            return None
+        for size in PREVIEW_SIZES:
+            if size < min(width, height):
+                continue  # Even the longer side of this level is too short
+            path = preview_storage.path(preview_level_name(thumbnail.name, size))
+            try:
+                with PIL.Image.open(path) as level:  # Reads only the header
+                    w, h = level.size
+            except (IOError, ValueError):
+                continue
+            scale = max(width / w, height / h) if crop else min(width / w, height / h)
+            if scale <= 1.0:
+                return path
+        return thumbnail.path
+
     def preview_ext(self):
         """Return the file extension of preview if it exists."""
         # TODO: use pathlib
@@ -455,57 +783,51 @@ class Image(models.Model):
         # TODO: do thumbnail out side of save() !
         """
         Generate thumbnail from open Image instance and save it
-        into thumb field
+        into thumb field. Pass a freshly opened image, it is decoded
+        in reduced size if possible and it may be modified.
+        Return the thumbnail image or False if it failed.
         """
         if thumbfield:
-            thumbfield.delete()  # Delete possible previous version
+            release_file(thumbfield)  # Delete possible previous version
         try:
-            im = image.copy()
+            im = filetools.scale_image(image, (t[0], t[1]), self.rotate, THUMBNAIL_REDUCING_GAP)
         except IOError:  # Image file is corrupted
             logging.warning(f"Failed to generate_thumb() content id = {self.content.id} {self.content.file}")
             return False
-        if im.mode not in ("L", "RGB"):
-            im = im.convert("RGB")
-        size = (t[0], t[1])
-        if self.rotate == 90:
-            im = im.transpose(PIL.Image.ROTATE_270)
-        elif self.rotate == 180:
-            im = im.transpose(PIL.Image.ROTATE_180)
-        elif self.rotate == 270:
-            im = im.transpose(PIL.Image.ROTATE_90)
-        im.thumbnail(size, PIL.Image.ANTIALIAS)
         # Save resized image to a temporary buffer
         tmp = io.BytesIO()
         im.save(tmp, "jpeg", quality=t[3])
         tmp.seek(0)
         data = tmp.read()
         tmp.close()
-        postfix = "{}-{}-{}x{}".format(t[0], t[1], t[2], t[3])
+        postfix = thumbnail_postfix(t)
         filename = "{:09d}-{}-{}.jpg".format(self.content.id, self.content.uid, postfix)
         thumbfield.save(filename, ContentFile(data))
-        return True
+        return im
 
     def re_generate_thumb(self):
         im = PIL.Image.open(self.content.file.path)
-        self.generate_thumb(im, self.thumbnail, THUMBNAIL_PARAMETERS)
+        thumb = self.generate_thumb(im, self.thumbnail, THUMBNAIL_PARAMETERS)
+        if thumb and self.content.preview.name == self.thumbnail.name:
+            self.content.generate_preview_levels(thumb)
+        rendition_cache.invalidate(self.content.uid)
 
     def save(self, *args, **kwargs):
-        im = None
+        # Thumbnail is generated in Content.generate_thumbnail(), so the image is decoded only once
         if self.content.file is not None and (self.width is None or self.height is None):
             try:
-                im = PIL.Image.open(self.content.file.path)
-                (self.width, self.height) = im.size
+                (self.width, self.height) = filetools.get_image_size(self.content.file.path)
             except IOError:
                 self.content.status = "INVALID"
                 self.content.save()
                 return
-        if im:
-            self.generate_thumb(im, self.thumbnail, THUMBNAIL_PARAMETERS)
         # TODO: author and other keys, see filetools.get_imageinfo
         # and iptcinfo.py
         super().save(*args, **kwargs)
-        self.content.status = "PROCESSED"
-        self.content.save()
+        # Content.process() sets PROCESSED itself, after the preview is ready
+        if self.content.status != "PROCESSING":
+            self.content.status = "PROCESSED"
+            self.content.save()
 
 
 class Video(models.Model):
@@ -539,16 +861,23 @@ class Video(models.Model):
             # Create temporary file for thumbnail
             fd, tmp_name = tempfile.mkstemp()  # Remember to close fd!
             if do_video_thumbnail(self.content.file.path, tmp_name):
-                t = THUMBNAIL_PARAMETERS
-                postfix = "{}-{}-{}x{}".format(t[0], t[1], t[2], t[3])
-                filename = "{:09d}-{}-{}.jpg".format(self.content.id, self.content.uid, postfix)
-                if os.path.isfile(tmp_name):
-                    with open(tmp_name, "rb") as f:
-                        self.thumbnail.save(filename, File(f))
-                    self.save()
-                    os.unlink(tmp_name)
+                self.set_thumbnail(tmp_name)
             os.close(fd)
 
+    def set_thumbnail(self, path: str) -> bool:
+        """
+        Save JPEG poster frame from `path` to thumbnail field and delete `path`.
+        """
+        if not os.path.isfile(path) or os.path.getsize(path) == 0:
+            return False
+        postfix = thumbnail_postfix(THUMBNAIL_PARAMETERS)
+        filename = "{:09d}-{}-{}.jpg".format(self.content.id, self.content.uid, postfix)
+        with open(path, "rb") as f:
+            self.thumbnail.save(filename, File(f))
+        self.save()
+        os.unlink(path)
+        return True
+
 
 class Videoinstance(models.Model):
     """
@@ -558,7 +887,7 @@ class Videoinstance(models.Model):
     TODO: images could be in separate model?
     duration - seconds
     bitrate - bits / sec
-    extension - file extension, e.g. '.ogg'
+    extension - transcoding profile name, e.g. 'webm' (it is the file extension for default profiles)
     width - pixels
     height - pixels
     framerate - frames / sec
@@ -577,14 +906,17 @@ class Videoinstance(models.Model):
     command = models.CharField(max_length=2000, editable=False)
     created = models.DateTimeField(auto_now_add=True)
 
-    def set_file(self, filepath, ext):
-        """Copy temporary file to video storage."""
+    def set_file(self, filepath, ext, name=None):
+        """
+        Copy temporary file to video storage.
+        `name` is the profile name, if it differs from file extension `ext`.
+        """
         self.mimetype = get_mimetype(filepath)
         filename = "{:09d}-{}.{}".format(self.id, self.content.uid, ext)
         with open(filepath, "rb") as f:
             self.file.save(filename, File(f))
             self.filesize = self.file.size
-            self.extension = ext
+            self.extension = name or ext
         self.save()
 
     def set_metadata(self, data):
@@ -632,13 +964,13 @@ class Audioinstance(models.Model):
     command = models.CharField(max_length=2000, editable=False)
     created = models.DateTimeField(auto_now_add=True)
 
-    def set_file(self, filepath, ext):
+    def set_file(self, filepath, ext, name=None):
         self.mimetype = get_mimetype(filepath)
         filename = "{:09d}-{}.{}".format(self.id, self.content.uid, ext)
         with open(filepath, "rb") as f:
             self.file.save(filename, File(f))
             self.filesize = self.file.size
-            self.extension = ext
+            self.extension = name or ext
         self.save()
 
     def set_metadata(self, data):
@@ -675,6 +1007,65 @@ class Uploadinfo(models.Model):
         self.useragent = request.META.get("HTTP_USER_AGENT", "")[:500]
 
 
+class Blob(models.Model):
+    """
+    A file shared by several Contents, when CONTENT_DEDUPLICATE is enabled.
+    refcount is the number of Contents referring to file `name` in storage
+    `storage` (a key of STORAGES). Blob exists only while the file is shared,
+    the last reference is a normal unshared file.
+    """
+
+    storage = models.CharField(max_length=16, editable=False)
+    name = models.CharField(max_length=500, editable=False)
+    sha1 = models.CharField(max_length=40, db_index=True, editable=False)
+    refcount = models.IntegerField(default=1, editable=False)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["storage", "name"], name="unique_blob_storage_name")]
+
+    @staticmethod
+    def storage_name(fieldfile) -> str:
+        for name, storage in STORAGES.items():
+            if fieldfile.storage is storage:
+                return name
+        raise ValueError(f"{fieldfile.name} is not in a shareable storage")
+
+    @classmethod
+    def share(cls, fieldfile, sha1: str):
+        """
+        Add a reference to the file of `fieldfile`. Its current owner is the first reference.
+        """
+        with transaction.atomic():
+            blob, created = cls.objects.select_for_update().get_or_create(
+                storage=cls.storage_name(fieldfile), name=fieldfile.name, defaults={"sha1": sha1}
+            )
+            blob.refcount += 1
+            blob.save()
+
+    @classmethod
+    def release(cls, fieldfile) -> int:
+        """
+        Remove a reference to the file of `fieldfile`.
+        Return the number of references left, 0 if the file was not shared.
+        """
+        with transaction.atomic():
+            try:
+                blob = cls.objects.select_for_update().get(storage=cls.storage_name(fieldfile), name=fieldfile.name)
+            except (cls.DoesNotExist, ValueError):
+                return 0
+            remaining = blob.refcount - 1
+            if remaining <= 1:
+                blob.delete()
+            else:
+                blob.refcount = remaining
+                blob.save()
+            return remaining
+
+    def __str__(self):
+        return f"{self.storage}/{self.name} ({self.refcount} refs)"
+
+
 class Mail(models.Model):
     """
     Retrieved Mail files
@@ -693,36 +1084,49 @@ class Mail(models.Model):
     )
     filesize = models.IntegerField(null=True, editable=False)
     file = models.FileField(storage=mail_storage, upload_to=upload_split_by_1000, editable=False)
-    md5 = models.CharField(max_length=32, db_index=True, editable=False)
-    sha1 = models.CharField(max_length=40, db_index=True, editable=False)
+    md5 = models.CharField(max_length=32, null=True, db_index=True, editable=False)
+    sha1 = models.CharField(max_length=40, null=True, db_index=True, editable=False)
     created = models.DateTimeField(auto_now_add=True)
     processed = models.DateTimeField(null=True)
 
+    class Meta:
+        # Only one non-duplicate Mail per file, this is what marks the others as DUPLICATE
+        constraints = [
+            models.UniqueConstraint(
+                fields=["md5", "sha1"], condition=~models.Q(status="DUPLICATE"), name="unique_mail_hashes"
+            )
+        ]
+
     def set_file(self, filecontent, host):
         """
-        Set Content.file and all it's related fields.
+        Set Mail.file and all it's related fields.
+        md5 and sha1 are calculated while the file is being written.
         filecontent may be
         - open file handle (opened in "rb"-mode)
         - existing file name (full path)
         - raw file data
-        NOTE: this reads all file content into memory
+        If an identical Mail exists already, status is set to DUPLICATE.
         """
+        self.md5 = self.sha1 = None
+        self.save()  # Must save here to get self.id
+        filename = "{:09d}-{}".format(self.id, host)
+        hasher = filetools.StreamHasher()
         if isinstance(filecontent, io.IOBase):
             filecontent.seek(0)
-            filedata = filecontent.read()
+            self.file.save(filename, HashingFile(filecontent, hasher))
         elif len(filecontent) < 1000 and os.path.isfile(filecontent):
             with open(filecontent, "rb") as f:
-                filedata = f.read()
+                self.file.save(filename, HashingFile(f, hasher))
         else:
-            filedata = filecontent
-        self.md5 = hashlib.md5(filedata).hexdigest()
-        self.sha1 = hashlib.sha1(filedata).hexdigest()
-        self.save()  # Must save here to get self.id
-        # root, ext = os.path.splitext(originalfilename)
-        filename = "{:09d}-{}".format(self.id, host)
-        self.file.save(filename, ContentFile(filedata))
+            self.file.save(filename, HashingFile(io.BytesIO(filecontent), hasher))
         self.filesize = self.file.size
-        cnt = Mail.objects.filter(md5=self.md5).filter(sha1=self.sha1).count()
-        if cnt > 1:
+        if hasher.size == self.filesize:
+            self.md5, self.sha1 = hasher.hexdigests()
+        else:  # Storage didn't read the file using chunks()
+            self.md5, self.sha1 = filetools.hashfile(self.file.path)
+        try:
+            with transaction.atomic():
+                self.save()
+        except IntegrityError:  # unique_mail_hashes: another fetcher saved this mail first
             self.status = "DUPLICATE"
-        self.save()
+            self.save()
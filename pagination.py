@@ -0,0 +1,125 @@
+"""
+Keyset pagination for the Content list API.
+
+Pages are ordered by (created, id) descending and the cursor is the
+(created, id) of the last row of the previous page, so fetching any page
+is an index range scan, however deep the client has scrolled:
+
+    /contents/?page_size=50
+    /contents/?page_size=50&cursor=<next cursor of the previous response>
+
+The total count is not calculated, unless it is asked with count=true.
+"""
+from __future__ import annotations
+
+import base64
+import binascii
+import datetime
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+PAGE_SIZE = getattr(settings, "CONTENT_PAGE_SIZE", 100)
+MAX_PAGE_SIZE = getattr(settings, "CONTENT_MAX_PAGE_SIZE", 1000)
+
+
+def encode_cursor(created: datetime.datetime, pk: int) -> str:
+    return base64.urlsafe_b64encode(f"{created.isoformat()}|{pk}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime.datetime, int]:
+    """
+    Return (created, id) from a cursor string. Raise ValueError if cursor is invalid.
+    """
+    try:
+        created, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        created = parse_datetime(created)
+        pk = int(pk)
+    except (TypeError, UnicodeDecodeError, binascii.Error) as err:
+        raise ValueError(str(err))
+    if created is None:
+        raise ValueError("Invalid timestamp")
+    return created, pk
+
+
+class KeysetPagination(BasePagination):
+    """
+    Paginate a Content queryset by (created, id), newest first.
+    Only forward links are provided, which is what infinite scrolling needs.
+    """
+
+    page_size = PAGE_SIZE
+    max_page_size = MAX_PAGE_SIZE
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    count_query_param = "count"
+    ordering = ("-created", "-id")
+
+    def get_page_size(self, request) -> int:
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_count(self, queryset, request) -> Optional[int]:
+        if request.query_params.get(self.count_query_param, "").lower() in ("1", "true", "yes"):
+            return queryset.count()
+        return None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.count = self.get_count(queryset, request)
+        queryset = queryset.order_by(*self.ordering)
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            try:
+                created, pk = decode_cursor(cursor)
+            except ValueError:
+                raise NotFound("Invalid cursor")
+            # created <= cursor is the index range condition, the OR alone would be only a filter
+            # applied to every row from the newest one down to the cursor
+            queryset = queryset.filter(created__lte=created).filter(
+                Q(created__lt=created) | Q(created=created, id__lt=pk)
+            )
+        # One extra row tells if there is a next page
+        results = list(queryset[: self.page_size + 1])
+        self.page = results[: self.page_size]
+        self.has_next = len(results) > self.page_size
+        return self.page
+
+    def get_next_link(self) -> Optional[str]:
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, encode_cursor(last.created, last.pk))
+
+    def get_first_link(self) -> str:
+        return remove_query_param(self.request.build_absolute_uri(), self.cursor_query_param)
+
+    def get_paginated_response(self, data):
+        response = OrderedDict([("next", self.get_next_link()), ("first", self.get_first_link())])
+        if self.count is not None:
+            response["count"] = self.count
+        response["results"] = data
+        return Response(response)
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "properties": {
+                "next": {"type": "string", "nullable": True},
+                "first": {"type": "string"},
+                "count": {"type": "integer"},
+                "results": schema,
+            },
+        }
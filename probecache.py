@@ -0,0 +1,124 @@
+"""
+Persistent cache for ffprobe results.
+
+Results are stored in an SQLite database file, keyed either by original
+file's sha1 or by (path, size, mtime), so an unchanged file is probed
+only once, even across processes and management command runs.
+Number of cached results is kept below `max_entries` by removing
+least recently used ones.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger("content")
+
+
+class ProbeCache:
+    """
+    Store and look up ffprobe's JSON output. Database errors are logged and
+    handled as cache misses, so a broken cache never prevents probing.
+    """
+
+    # Check the number of entries after this many put()s
+    EVICT_INTERVAL = 100
+
+    def __init__(self, path: str, max_entries: int = 100000):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._puts = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    @staticmethod
+    def file_key(path: str, sha1: str = None) -> str | None:
+        """
+        Return cache key of a file or None if the file does not exist.
+        """
+        if sha1:
+            return f"sha1:{sha1}"
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return f"{os.path.realpath(path)}:{st.st_size}:{st.st_mtime_ns}"
+
+    def _connect(self) -> sqlite3.Connection:
+        # Connections can't be shared between threads or forked processes
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS probe (key TEXT PRIMARY KEY, data TEXT, used REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS probe_used ON probe (used)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key: str) -> dict | None:
+        """
+        Return cached ffprobe data or None if it is not in the cache.
+        """
+        if not self.enabled or key is None:
+            return None
+        try:
+            conn = self._connect()
+            row = conn.execute("SELECT data FROM probe WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE probe SET used = ? WHERE key = ?", (time.time(), key))
+            return json.loads(row[0])
+        except (sqlite3.Error, ValueError) as err:
+            log.warning(f"Probe cache {self.path} get failed: {err}")
+            return None
+
+    def put(self, key: str, data: dict):
+        if not self.enabled or key is None:
+            return
+        try:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO probe (key, data, used) VALUES (?, ?, ?)", (key, json.dumps(data), time.time())
+            )
+        except sqlite3.Error as err:
+            log.warning(f"Probe cache {self.path} put failed: {err}")
+            return
+        self._puts += 1
+        if self._puts % self.EVICT_INTERVAL == 1:
+            self.evict()
+
+    def evict(self, target: float = 0.9) -> int:
+        """
+        Remove least recently used entries until at most `max_entries` * target remain.
+        Return the number of removed entries.
+        """
+        try:
+            conn = self._connect()
+            count = conn.execute("SELECT COUNT(*) FROM probe").fetchone()[0]
+            if count <= self.max_entries:
+                return 0
+            excess = count - int(self.max_entries * target)
+            conn.execute(
+                "DELETE FROM probe WHERE key IN (SELECT key FROM probe ORDER BY used LIMIT ?)",
+                (excess,),
+            )
+        except sqlite3.Error as err:
+            log.warning(f"Probe cache {self.path} eviction failed: {err}")
+            return 0
+        log.debug(f"Evicted {excess} entries from probe cache {self.path}")
+        return excess
+
+    def clear(self):
+        try:
+            self._connect().execute("DELETE FROM probe")
+        except sqlite3.Error as err:
+            log.warning(f"Probe cache {self.path} clear failed: {err}")
@@ -0,0 +1,112 @@
+"""
+Pool of pre-warmed worker processes for reading file metadata.
+
+Every worker has python-magic, PIL and filetools already loaded, so a job
+costs only the inter-process round trip and the work itself. ffprobe and
+ImageMagick's convert are still external commands, but their fork/exec
+latency is overlapped by running them in several workers at a time.
+
+Usage:
+
+    with ProbePool(workers=4) as pool:
+        for path, (mimetype, ffp) in pool.probe_files(paths):
+            ...
+"""
+from __future__ import annotations
+
+import concurrent.futures
+import logging
+import os
+from typing import Iterable, Iterator, Tuple
+
+import PIL.Image
+
+from content import filetools
+
+log = logging.getLogger("content")
+
+
+def _init_worker():
+    # Load everything a job needs before the first job arrives
+    PIL.Image.init()
+    filetools.get_mimetype_from_buffer(b"")
+
+
+def _probe_job(path: str, sha1: str = None) -> Tuple[str, dict]:
+    return filetools.get_mimetype(path), _ffprobe_job(path, sha1)
+
+
+def _ffprobe_job(path: str, sha1: str = None) -> dict:
+    return filetools.FFProbe(path, sha1=sha1).data
+
+
+def _pdf_thumbnail_job(src: str, target: str) -> bool:
+    return filetools.do_pdf_thumbnail(src, target)
+
+
+class ProbePool:
+    """
+    Run get_mimetype(), FFProbe and do_pdf_thumbnail() in a process pool.
+    Results are the same as returned by the filetools functions.
+    """
+
+    def __init__(self, workers: int = None):
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = None
+
+    def start(self):
+        if self.executor is None:
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+            # Start all workers now, not lazily when the first jobs arrive
+            for future in [self.executor.submit(os.getpid) for _ in range(self.workers)]:
+                future.result()
+        return self
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self) -> ProbePool:
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def submit_probe(self, path: str, sha1: str = None) -> concurrent.futures.Future:
+        """
+        Return a Future of (mimetype, ffprobe data) of the file in `path`.
+        """
+        return self.start().executor.submit(_probe_job, path, sha1)
+
+    def ffprobe(self, path: str, sha1: str = None) -> filetools.FFProbe:
+        # Only ffprobe, FileProbe gets the mimetype separately with mimetype()
+        data = self.start().executor.submit(_ffprobe_job, path, sha1).result()
+        return filetools.FFProbe(path, sha1=sha1, data=data)
+
+    def mimetype(self, path: str) -> str:
+        return self.start().executor.submit(filetools.get_mimetype, path).result()
+
+    def pdf_thumbnail(self, src: str, target: str) -> bool:
+        return self.start().executor.submit(_pdf_thumbnail_job, src, target).result()
+
+    def probe_files(self, paths: Iterable[str]) -> Iterator[Tuple[str, Tuple[str, filetools.FFProbe]]]:
+        """
+        Probe all `paths` in parallel and yield (path, (mimetype, FFProbe)) tuples in completion order.
+        At most 2 * workers jobs are queued at a time, so `paths` may be a lazy iterator.
+        """
+        paths = iter(paths)
+        pending = {}
+        self.start()
+        while True:
+            for path in paths:
+                pending[self.executor.submit(_probe_job, path)] = path
+                if len(pending) >= self.workers * 2:
+                    break
+            if not pending:
+                break
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                mimetype, data = future.result()
+                yield path, (mimetype, filetools.FFProbe(path, data=data))
@@ -0,0 +1,169 @@
+"""
+Transcoding profiles for video and audio instances.
+
+Profiles can be configured in settings, e.g.
+
+CONTENT_TRANSCODING_PROFILES = [
+    {"name": "webm", "kind": "video", "ext": "webm", "mimetype": "video/webm",
+     "audio_codec": "libvorbis", "audio_bitrate": "96k", "height": 360},
+    {"name": "mp4", "kind": "video", "ext": "mp4", "mimetype": "video/mp4",
+     "codec": "libx264", "audio_bitrate": "64k", "height": 360},
+    {"name": "mp4_720", "kind": "video", "ext": "mp4", "mimetype": "video/mp4",
+     "codec": "libx264", "bitrate": "2500k", "audio_bitrate": "128k", "height": 720},
+    {"name": "opus", "kind": "audio", "ext": "opus", "mimetype": "audio/ogg",
+     "codec": "libopus", "bitrate": "48k"},
+]
+
+Profile name is saved to Video/Audioinstance.extension and used in instance URLs,
+so it must not contain dots or slashes. Video profiles, whose target height
+exceeds the height of the source video, are skipped. If that would leave a
+container (ext) without any instance, its lowest profile is encoded
+in source's own height instead of upscaling.
+"""
+from __future__ import annotations
+
+import functools
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+DEFAULT_PROFILES = [
+    {
+        "name": "webm",
+        "kind": "video",
+        "ext": "webm",
+        "mimetype": "video/webm",
+        "audio_codec": "libvorbis",
+        "audio_bitrate": "96k",
+        "height": 360,
+        "params": ["-ac", "2", "-ar", "22050"],
+    },
+    {
+        "name": "mp4",
+        "kind": "video",
+        "ext": "mp4",
+        "mimetype": "video/mp4",
+        "codec": "libx264",
+        "audio_bitrate": "64k",
+        "height": 360,
+        "params": ["-preset", "fast", "-vprofile", "baseline", "-vsync", "2", "-async", "1"]
+        + ["-f", "mp4", "-movflags", "faststart"],
+    },
+    {"name": "ogg", "kind": "audio", "ext": "ogg", "mimetype": "audio/ogg", "codec": "libvorbis", "bitrate": "32k"},
+    {"name": "mp3", "kind": "audio", "ext": "mp3", "mimetype": "audio/mpeg", "codec": "libmp3lame", "bitrate": "64k"},
+]
+
+
+class Profile:
+    """
+    One video or audio rendition: codecs, bitrates, target height, container and mimetype.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        kind: str,
+        ext: str,
+        mimetype: str,
+        codec: str = None,
+        bitrate: str = None,
+        height: int = None,
+        audio_codec: str = None,
+        audio_bitrate: str = None,
+        params: list = (),
+    ):
+        if kind not in ("video", "audio"):
+            raise ValueError(f"Profile {name}: kind must be 'video' or 'audio', not '{kind}'")
+        if "." in name or "/" in name:
+            raise ValueError(f"Profile {name}: name must not contain '.' or '/'")
+        self.name = name
+        self.kind = kind
+        self.ext = ext
+        self.mimetype = mimetype
+        self.codec = codec
+        self.bitrate = bitrate
+        self.height = height
+        self.audio_codec = audio_codec
+        self.audio_bitrate = audio_bitrate
+        self.params = list(params)
+
+    def fits(self, source_height: Optional[int]) -> bool:
+        """
+        Return True if this profile doesn't upscale a video, which is `source_height` px high.
+        """
+        return self.height is None or not source_height or self.height <= source_height
+
+    def scale_filter(self, source_height: Optional[int] = None) -> Optional[str]:
+        if self.height is None:
+            return None
+        height = min(self.height, source_height) if source_height else self.height
+        height -= height % 2  # Most codecs require even dimensions
+        return f"scale=trunc(oh*a/2)*2:{height}"
+
+    def ffmpeg_params(self, source_height: Optional[int] = None) -> List[str]:
+        """
+        Return ffmpeg output parameters of this profile.
+        """
+        params = []
+        if self.kind == "video":
+            if self.codec:
+                params += ["-vcodec", self.codec]
+            if self.bitrate:
+                params += ["-b:v", self.bitrate]
+            scale = self.scale_filter(source_height)
+            if scale:
+                params += ["-vf", scale]
+            if self.audio_codec:
+                params += ["-acodec", self.audio_codec]
+            if self.audio_bitrate:
+                params += ["-b:a", self.audio_bitrate]
+        else:
+            params += ["-vn"]
+            if self.codec:
+                params += ["-acodec", self.codec]
+            if self.bitrate:
+                params += ["-b:a", self.bitrate]
+        return params + self.params
+
+    def __repr__(self):
+        return f"<Profile {self.name} ({self.kind}, {self.ext}, {self.height or '-'})>"
+
+
+def load_profiles(config: List[dict]) -> Dict[str, Profile]:
+    """
+    Create Profiles from a list of dicts, see DEFAULT_PROFILES.
+    """
+    profiles = {}
+    for item in config:
+        profile = Profile(**item)
+        profiles[profile.name] = profile
+    return profiles
+
+
+def select_profiles(profiles: Dict[str, Profile], kind: str, source_height: Optional[int] = None) -> List[Profile]:
+    """
+    Return profiles of `kind` ('video' or 'audio') to be encoded from a source,
+    which is `source_height` px high, skipping profiles which would upscale it.
+    """
+    candidates = [p for p in profiles.values() if p.kind == kind]
+    selected = [p for p in candidates if p.fits(source_height)]
+    covered = {p.ext for p in selected}
+    for p in sorted(candidates, key=lambda p: p.height or 0):
+        if p.ext not in covered:  # Encode at least one instance of every container
+            selected.append(p)
+            covered.add(p.ext)
+    return selected
+
+
+@functools.lru_cache(maxsize=None)
+def configured_profiles() -> Dict[str, Profile]:
+    """
+    Return the profiles of CONTENT_TRANSCODING_PROFILES setting, or DEFAULT_PROFILES
+    if it is not set or Django settings are not configured (e.g. scripts using only filetools).
+    """
+    try:
+        config = getattr(settings, "CONTENT_TRANSCODING_PROFILES", DEFAULT_PROFILES)
+    except ImproperlyConfigured:
+        config = DEFAULT_PROFILES
+    return load_profiles(config)
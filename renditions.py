@@ -0,0 +1,140 @@
+"""
+Disk-backed cache for resized preview renditions.
+
+Scaled and cropped previews are stored in a directory of their own
+(by default 'renditions' inside preview_storage), one subdirectory per
+Content uid, so all renditions of a Content can be invalidated at once.
+Total size of the cache is kept below `max_size` bytes by removing
+least recently used renditions.
+"""
+from __future__ import annotations
+
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+
+log = logging.getLogger("content")
+
+
+class RenditionCache:
+    """
+    Store and look up rendered preview files.
+
+    Rendition key contains Content.updated timestamp, so a rendition of
+    an older version of a Content is never returned, even if invalidate()
+    was not called for some reason.
+    """
+
+    def __init__(self, location: str, max_size: int = 1024**3):
+        self.location = location
+        self.max_size = max_size
+        # Bytes written since the last eviction scan, see _maybe_evict()
+        self._written = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    @staticmethod
+    def key(width: int, height: int, action: str | None, ext: str, updated: datetime.datetime | None) -> str:
+        """
+        Return rendition's file name, e.g. '640x480-crop-1651234567123456.jpeg'
+        """
+        ts = int(updated.timestamp() * 1000000) if updated else 0
+        return "{}x{}{}-{}.{}".format(width, height, action or "", ts, ext)
+
+    def _dir(self, uid: str) -> str:
+        return os.path.join(self.location, uid[:2], uid)
+
+    def path(self, uid: str, key: str) -> str:
+        return os.path.join(self._dir(uid), key)
+
+    def get(self, uid: str, key: str) -> bytes | None:
+        """
+        Return cached rendition's data or None if it is not in the cache.
+        """
+        if not self.enabled:
+            return None
+        path = self.path(uid, key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        try:  # Update mtime, which is used as the last access time in eviction
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def put(self, uid: str, key: str, data: bytes):
+        """
+        Save rendition to the cache. File is written to a temporary file
+        first and then renamed, so concurrent readers never see partial files.
+        """
+        if not self.enabled:
+            return
+        dirname = self._dir(uid)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_name, self.path(uid, key))
+        except OSError as err:
+            log.warning(f"Failed to save rendition {uid}/{key}: {err}")
+            if os.path.isfile(tmp_name):
+                os.unlink(tmp_name)
+            return
+        self._maybe_evict(len(data))
+
+    def invalidate(self, uid: str):
+        """
+        Remove all renditions of Content `uid`.
+        """
+        shutil.rmtree(self._dir(uid), ignore_errors=True)
+
+    def _maybe_evict(self, size: int):
+        # Walking through the whole cache directory on every write would be
+        # expensive, so scan only after ~5% of max_size has been written
+        # since the previous scan (and always after a process has started).
+        if self._written is not None:
+            self._written += size
+            if self._written < self.max_size // 20:
+                return
+        self._written = 0
+        self.evict()
+
+    def evict(self, target: float = 0.9) -> int:
+        """
+        Remove least recently used renditions until cache size is below
+        `target` * max_size. Return the number of bytes removed.
+        """
+        files = []
+        total = 0
+        for root, dirs, filenames in os.walk(self.location):
+            for name in filenames:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:  # Removed by another process
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        if total <= self.max_size:
+            return 0
+        removed = 0
+        limit = self.max_size * target
+        files.sort()
+        for mtime, size, path in files:
+            if total - removed <= limit:
+                break
+            try:
+                os.unlink(path)
+                removed += size
+            except OSError:
+                pass
+        log.debug(f"Evicted {removed} bytes of renditions from {self.location}")
+        return removed
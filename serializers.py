@@ -60,6 +60,7 @@ class ContentSerializer(serializers.HyperlinkedModelSerializer):
             "sha1",
             "point",
             "mimetype",
+            "status",
             "created_at",
             "updated_at",
         ]
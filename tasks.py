@@ -3,6 +3,8 @@ from celery.task import Task
 from celery import task
 from django.core import management
 
+from content.models import Content
+
 
 # This is having some problems with celery 3.0.13 and mod_wsgi
 class CreateInstancesTask(Task):
@@ -16,3 +18,13 @@ tasks.register(CreateInstancesTask)
 @task()
 def create_instances_task(pk):
     management.call_command("create_instances", verbosity=0, pk=pk)
+
+
+@task()
+def process_content_task(pk):
+    """
+    Extract metadata and generate thumbnail for an uploaded Content,
+    see Content.process().
+    """
+    c = Content.objects.get(pk=pk)
+    c.process()
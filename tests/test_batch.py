@@ -0,0 +1,59 @@
+import os
+import tempfile
+import unittest
+
+from content.batch import Checkpoint, Throughput, run_jobs
+
+
+def _square(x):
+    if x == 3:
+        raise ValueError("3 is not allowed")
+    return x * x
+
+
+class CheckpointTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "checkpoint.txt")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def testResume(self):
+        done = Checkpoint(self.path)
+        done.add(1)
+        done.add("2")
+        self.assertIn(1, done)
+        resumed = Checkpoint(self.path)
+        self.assertIn(1, resumed)
+        self.assertIn(2, resumed)
+        self.assertNotIn(3, resumed)
+
+    def testWithoutPath(self):
+        done = Checkpoint(None)
+        done.add(1)
+        self.assertIn(1, done)
+        self.assertFalse(os.path.exists(self.path))
+
+
+class RunJobsTestCase(unittest.TestCase):
+    def checkResults(self, workers):
+        results = {job[0]: (result, err) for job, result, err in run_jobs(_square, [(i,) for i in range(6)], workers)}
+        self.assertEqual(len(results), 6)
+        self.assertEqual(results[4], (16, None))
+        result, err = results[3]
+        self.assertIsNone(result)
+        self.assertIsInstance(err, ValueError)
+
+    def testSerial(self):
+        self.checkResults(1)
+
+    def testPoolPropagatesErrors(self):
+        self.checkResults(2)
+
+    def testThroughput(self):
+        throughput = Throughput(total=6)
+        for job, result, err in run_jobs(_square, [(i,) for i in range(6)]):
+            throughput.update(contents=int(err is None), failed=int(err is not None))
+        self.assertEqual((throughput.jobs, throughput.contents, throughput.failed), (6, 5, 1))
+        self.assertIn("6/6 jobs (1 failed)", throughput.report())
@@ -0,0 +1,151 @@
+import io
+import os
+import tempfile
+from unittest import mock
+
+import PIL.Image
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.test import TestCase
+
+from content.batch import Checkpoint
+from content.filetools import RunResult
+from content.management.commands import create_instances
+from content.models import Content, Video, Videoinstance, release_file
+from content.profiles import DEFAULT_PROFILES, load_profiles
+
+
+class RegeneratePreviewsTestCase(TestCase):
+    def setUp(self):
+        self.contents = []
+        for color in ["red", "blue"]:
+            f = io.BytesIO()
+            PIL.Image.new("RGB", (320, 240), color).save(f, "png")
+            c = Content(caption=f"Regenerate {color}")
+            c.save_file(f"{color}.png", f.getvalue())
+            c.process()
+            self.contents.append(c)
+
+    def tearDown(self):
+        for c in Content.objects.all():
+            release_file(c.file)
+            release_file(c.preview)
+
+    def regenerate(self, *args) -> str:
+        out = io.StringIO()
+        call_command("regenerate_previews", *args, stdout=out)
+        return out.getvalue().strip()
+
+    def testOnlyOutdatedPreviewsAreRegenerated(self):
+        self.assertEqual(self.regenerate(), "Regenerated 0 previews, 2 skipped")
+        outdated = self.contents[0]
+        Content.objects.filter(pk=outdated.pk).update(preview="preview/outdated-1-1-JPEGx1.jpg")
+        self.assertEqual(self.regenerate("--dry-run"), "Would regenerate 1 previews, 1 skipped")
+        self.assertEqual(self.regenerate(), "Regenerated 1 previews, 1 skipped")
+        self.assertTrue(Content.objects.get(pk=outdated.pk).preview_is_up_to_date())
+        self.assertEqual(self.regenerate(), "Regenerated 0 previews, 2 skipped")
+
+    def testForce(self):
+        with mock.patch.object(Content, "generate_thumbnail", autospec=True) as generate_thumbnail:
+            self.assertEqual(self.regenerate("--force"), "Regenerated 2 previews, 0 skipped")
+        # Forced previews are rendered, not shared from identical Contents
+        self.assertEqual([call.kwargs for call in generate_thumbnail.call_args_list], [{"share": False}] * 2)
+
+    def testMimetypeSelector(self):
+        selections = [
+            (["image"], 2),  # Mediatype
+            (["image/png"], 2),  # Mimetype prefix
+            (["image/jpeg"], 0),
+            (["video", "application/pdf"], 0),
+            (["video", "image/png"], 2),
+        ]
+        for mimetypes, count in selections:
+            args = ["--force", "--dry-run"] + [arg for mimetype in mimetypes for arg in ("--mimetype", mimetype)]
+            self.assertEqual(self.regenerate(*args), f"Would regenerate {count} previews, 0 skipped", mimetypes)
+        # Mediatype matches Contents, whose mimetype does not start with it
+        Content.objects.filter(pk=self.contents[0].pk).update(mimetype="application/octet-stream")
+        self.assertEqual(
+            self.regenerate("--force", "--dry-run", "--mimetype", "image"), "Would regenerate 2 previews, 0 skipped"
+        )
+        self.assertEqual(
+            self.regenerate("--force", "--dry-run", "--mimetype", "image/"), "Would regenerate 1 previews, 0 skipped"
+        )
+
+
+# Default profiles and one, which would upscale a 360 px high source
+PROFILES = load_profiles(
+    DEFAULT_PROFILES
+    + [{"name": "mp4_720", "kind": "video", "ext": "mp4", "mimetype": "video/mp4", "codec": "libx264", "height": 720}]
+)
+
+
+@mock.patch.object(create_instances, "TRANSCODING_PROFILES", PROFILES)
+class CreateInstancesTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.checkpoint = os.path.join(self.tmpdir.name, "checkpoint.txt")
+        self.content = Content(caption="Create instances")
+        self.content.save_file("video.mp4", b"not really a video")
+        self.content.mimetype, self.content.mediatype = "video/mp4", "video"
+        self.content.preview.name = "preview.jpg"  # No poster is needed
+        self.content.save()
+        Video.objects.create(content=self.content, width=640, height=360)
+        self.old = {name: self.createInstance(name) for name in ["webm", "mp4", "mp4_720", "removed"]}
+        probe = mock.Mock()
+        probe.ffprobe.is_video.return_value = True
+        probe.ffprobe.get_videoinfo.return_value = {"width": 640, "height": 360, "duration": 10.0}
+        patcher = mock.patch.object(Content, "get_probe", return_value=probe)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        for inst in Videoinstance.objects.all():
+            release_file(inst.file)
+        release_file(self.content.file)
+
+    def createInstance(self, name: str) -> Videoinstance:
+        inst = Videoinstance(content=self.content, mimetype="video/mp4", extension=name)
+        inst.file.save(f"old.{name}", ContentFile(b"old instance"))
+        return inst
+
+    def transcode(self, failing: list):
+        def transcode(filepath, outputs, thumbnail=None, sec=None):
+            results = []
+            for kind, params, ext in outputs:
+                fd, outfile = tempfile.mkstemp(suffix="." + ext, dir=self.tmpdir.name)
+                os.write(fd, b"new instance")
+                os.close(fd)
+                info = {} if ext in failing else {"width": 640, "height": 360, "duration": 10.0}
+                results.append((outfile, info))
+            return RunResult("ffmpeg ...", 0, 1.0), results
+
+        return mock.patch.object(create_instances, "transcode", side_effect=transcode)
+
+    def instanceIds(self) -> dict:
+        return dict(self.content.videoinstances.values_list("extension", "id"))
+
+    def testFailedProfileIsRetried(self):
+        with self.transcode(failing=["mp4"]) as transcode:
+            create_instances.create_instances(
+                limit=0, pk=self.content.pk, uid=None, redo=True, checkpoint=self.checkpoint
+            )
+        # Upscaling mp4_720 is not encoded
+        self.assertEqual([ext for kind, params, ext in transcode.call_args.args[1]], ["webm", "mp4"])
+        self.assertNotIn(self.content.pk, Checkpoint(self.checkpoint))
+        ids = self.instanceIds()
+        self.assertEqual(set(ids), {"webm", "mp4", "mp4_720"})
+        self.assertNotEqual(ids["webm"], self.old["webm"].id)
+        # Old instances of the failed and the skipped profile survive, the removed profile's instance is deleted
+        self.assertEqual(ids["mp4"], self.old["mp4"].id)
+        self.assertEqual(ids["mp4_720"], self.old["mp4_720"].id)
+        self.assertTrue(os.path.isfile(self.old["mp4"].file.path))
+        self.assertFalse(os.path.isfile(self.old["removed"].file.path))
+        with self.transcode(failing=[]):
+            create_instances.create_instances(
+                limit=0, pk=self.content.pk, uid=None, redo=True, checkpoint=self.checkpoint
+            )
+        self.assertIn(self.content.pk, Checkpoint(self.checkpoint))
+        self.assertNotEqual(self.instanceIds()["mp4"], self.old["mp4"].id)
+        self.assertFalse(os.path.isfile(self.old["mp4"].file.path))
+        self.assertEqual(self.instanceIds()["mp4_720"], self.old["mp4_720"].id)
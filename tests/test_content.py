@@ -1,14 +1,21 @@
+import hashlib
+import io
 import os
+import tempfile
 import unittest
 from pathlib import Path
+from unittest import mock
 
+import PIL.Image
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
 from django.test import TestCase
 
 import content.filetools
 from content.filetools import create_videoinstance, create_audioinstance
-from content.models import Content
+from content.models import Blob, Content, Mail, release_file, thumbnail_postfix
 from content.models import Videoinstance, Audioinstance
-from content.models import content_storage, preview_storage
+from content.models import content_storage, mail_storage, preview_storage
 
 TEST_CONTENT_DIR = Path(__file__).resolve().parent / Path("testfiles")
 AUDIO_DIR = TEST_CONTENT_DIR / Path("audio")
@@ -57,7 +64,7 @@ class ContentTestCase(unittest.TestCase):
                 info = content.filetools.fileinfo(c.file.path)
                 print(info)
                 if ffp.is_video():
-                    new_video, cmd_str, output = create_videoinstance(c.file.path)
+                    new_video, result = create_videoinstance(c.file.path)
                     vi = Videoinstance(content=c)
                     vi.save()
                     vi.set_file(new_video, "webm")
@@ -65,7 +72,7 @@ class ContentTestCase(unittest.TestCase):
                     vi.save()
                     print(f"{c.mimetype} {c.preview} {vi.mimetype} {vi.duration:.1f} sec {vi.width}x{vi.height} px")
                 if ffp.is_audio():
-                    new_audio, cmd_str, output = create_audioinstance(c.file.path)
+                    new_audio, result = create_audioinstance(c.file.path)
                     ai = Audioinstance(content=c)
                     ai.save()
                     ai.set_file(new_audio, "ogg")
@@ -101,7 +108,7 @@ class ContentTestCase(unittest.TestCase):
                 print(info)
 
                 if ffp.is_video():
-                    new_video, cmd_str, output = create_videoinstance(c.file.path)
+                    new_video, result = create_videoinstance(c.file.path)
                     vi = Videoinstance(content=c)
                     vi.save()
                     vi.set_file(new_video, "webm")
@@ -110,7 +117,7 @@ class ContentTestCase(unittest.TestCase):
                     print("%s %.1f sec %dx%d pix" % (vi.mimetype, vi.duration, vi.width, vi.height))
 
                 if ffp.is_audio():
-                    new_audio, cmd_str, output = create_audioinstance(c.file.path)
+                    new_audio, result = create_audioinstance(c.file.path)
                     ai = Audioinstance(content=c)
                     ai.save()
                     ai.set_file(new_audio, "ogg")
@@ -166,10 +173,214 @@ class FiletoolsTestCase(TestCase):
         for filename in files:
             cnt += 1
             path = os.path.join(test_dir, str(filename))
-            new_video, cmd_str, output = content.filetools.create_videoinstance(path)
+            new_video, result = content.filetools.create_videoinstance(path)
             ffp = content.filetools.FFProbe(new_video)
             print(new_video, ffp.get_videoinfo())
             os.unlink(new_video)
             # self.assertTrue(ffp.is_video(), "Error '%s'" % filename)
             # self.assertFalse(ffp.is_audio(), "Error '%s'" % filename)
         print(f"Tested {cnt} video files")
+
+
+class ProbeCountTestCase(TestCase):
+    def testExternalToolsRunOncePerFile(self):
+        for testdir in [IMAGE_DIR, VIDEO_DIR, AUDIO_DIR]:
+            for filename in os.listdir(testdir):
+                content.filetools.CALL_COUNTER.clear()
+                c = Content(caption=f"Probe count {filename}")
+                c.set_file(str(filename), os.path.join(testdir, filename))
+                c.set_fileinfo()
+                c.generate_thumbnail()
+                for tool, count in content.filetools.CALL_COUNTER.items():
+                    self.assertEqual(count, 1, f"{tool} was run {count} times for '{filename}'")
+                content_storage.delete(c.file.path)
+                if c.preview:
+                    preview_storage.delete(c.preview.path)
+
+    def testImageIsDecodedOnce(self):
+        for filename in os.listdir(IMAGE_DIR):
+            content.filetools.CALL_COUNTER.clear()
+            c = Content(caption=f"Decode count {filename}")
+            c.set_file(str(filename), os.path.join(IMAGE_DIR, filename))
+            c.set_fileinfo()
+            c.generate_thumbnail()
+            self.assertEqual(content.filetools.CALL_COUNTER["decode"], 1, f"'{filename}' was not decoded once")
+            self.assertIsNotNone(c.image.width)
+            content_storage.delete(c.file.path)
+            if c.preview:
+                preview_storage.delete(c.preview.path)
+
+
+class PreviewVersionTestCase(unittest.TestCase):
+    def isUpToDate(self, name: str) -> bool:
+        return Content(preview=name).preview_is_up_to_date()
+
+    def testPreviewIsUpToDate(self):
+        postfix = thumbnail_postfix()
+        self.assertTrue(self.isUpToDate(f"000/000/000000001-abc-{postfix}.jpg"))
+        self.assertTrue(self.isUpToDate(f"000/000/000000001-abc-{postfix}.png"))
+        # Random suffix added by storage, when the name was taken
+        self.assertTrue(self.isUpToDate(f"000/000/000000001-abc-{postfix}_AbCdEf1.jpg"))
+        self.assertFalse(self.isUpToDate(""))
+        self.assertFalse(self.isUpToDate("000/000/000000001-abc-1-1-JPEGx1.jpg"))
+        self.assertFalse(self.isUpToDate(f"000/000/000000001-abc-{postfix}-old.jpg"))
+        self.assertFalse(self.isUpToDate(f"000/000/000000001-abc-{postfix.replace('-', '')}.jpg"))
+
+
+class SaveFileTestCase(TestCase):
+    def setUp(self):
+        self.data = os.urandom(300000)  # Storage reads this in several chunks
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = os.path.join(self.tmpdir.name, "data.bin")
+        with open(self.path, "wb") as f:
+            f.write(self.data)
+
+    def saveFile(self, filecontent, mimetype=None) -> Content:
+        c = Content(caption="Save file")
+        c.set_file("data.bin", filecontent, mimetype)
+        self.addCleanup(release_file, c.file)
+        self.assertEqual(c.filesize, len(self.data))
+        self.assertEqual((c.md5, c.sha1), content.filetools.hashfile(c.file.path))
+        self.assertEqual((c.md5, c.sha1), content.filetools.hashfile(self.path))
+        return c
+
+    def testHashesOfAllInputTypes(self):
+        self.saveFile(SimpleUploadedFile("data.bin", self.data))
+        with open(self.path, "rb") as f:
+            self.saveFile(f)
+        self.saveFile(self.path)
+        self.saveFile(self.data)
+
+    def testTemporaryUploadIsMoved(self):
+        upload = TemporaryUploadedFile("data.bin", "application/octet-stream", len(self.data), None)
+        upload.write(self.data)
+        upload.flush()
+        tmp_path = upload.temporary_file_path()
+        self.saveFile(upload)
+        self.assertFalse(os.path.exists(tmp_path))
+        upload.close()
+
+    def testExplicitMimetypeIsNotProbed(self):
+        with mock.patch("content.filetools.get_mimetype_from_buffer") as get_mimetype:
+            with mock.patch("content.filetools.FileProbe.fileinfo") as fileinfo:
+                c = self.saveFile(self.data, mimetype="application/pdf")
+        get_mimetype.assert_not_called()
+        fileinfo.assert_not_called()
+        self.assertEqual((c.mimetype, c.mediatype), ("application/pdf", "document"))
+        self.assertEqual(c.get_probe().mimetype, "application/pdf")
+
+
+class ProcessTestCase(TestCase):
+    def createContent(self, data: bytes) -> Content:
+        c = Content(caption="Process")
+        c.save_file("photo.png", data)
+        c.save()
+        self.addCleanup(release_file, c.file)
+        return c
+
+    def testProcess(self):
+        f = io.BytesIO()
+        PIL.Image.new("RGB", (320, 240), "red").save(f, "png")
+        c = self.createContent(f.getvalue())
+        self.assertEqual(c.status, "UNPROCESSED")
+        self.assertIsNone(c.mediatype)
+        statuses = []
+
+        def check_status(method):
+            def wrapper(c, *args, **kwargs):
+                statuses.append((method.__name__, Content.objects.get(pk=c.pk).status))
+                return method(c, *args, **kwargs)
+
+            return mock.patch.object(Content, method.__name__, autospec=True, side_effect=wrapper)
+
+        with check_status(Content.set_filemeta), check_status(Content.generate_thumbnail):
+            c.process()
+        # Client polling the status must not see PROCESSED before the preview exists
+        self.assertEqual(statuses, [("set_filemeta", "PROCESSING"), ("generate_thumbnail", "PROCESSING")])
+        c = Content.objects.get(pk=c.pk)
+        self.addCleanup(release_file, c.preview)
+        self.assertEqual(c.status, "PROCESSED")
+        self.assertEqual((c.mimetype, c.mediatype), ("image/png", "image"))
+        self.assertEqual((c.image.width, c.image.height), (320, 240))
+        self.assertTrue(c.preview)
+        self.assertTrue(os.path.isfile(c.preview.path))
+
+    def testFailedProcess(self):
+        c = self.createContent(b"\x89PNG\r\n\x1a\n" + b"\0" * 1000)  # Truncated image
+        with self.assertRaises(OSError):
+            c.process()
+        c = Content.objects.get(pk=c.pk)
+        self.assertEqual(c.status, "FAILED")
+        self.assertEqual(c.mimetype, "image/png")
+        self.assertFalse(c.preview)
+
+
+class MailTestCase(TestCase):
+    def testSetFileMarksDuplicates(self):
+        data = b"From: test@example.com\r\nSubject: duplicate\r\n\r\n" + os.urandom(200000)
+        first, second = Mail(), Mail()
+        first.set_file(io.BytesIO(data), "imap.example.com")
+        second.set_file(data, "imap.example.com")
+        self.assertEqual(first.status, "UNPROCESSED")
+        self.assertEqual(second.status, "DUPLICATE")
+        self.assertEqual(first.filesize, len(data))
+        self.assertEqual(first.sha1, hashlib.sha1(data).hexdigest())
+        self.assertEqual((first.md5, first.sha1), (second.md5, second.sha1))
+        for mail in [first, second]:
+            mail_storage.delete(mail.file.name)
+
+
+@mock.patch("content.models.DEDUPLICATE", True)
+class DeduplicateTestCase(TestCase):
+    def createContent(self, data: bytes) -> Content:
+        c = Content(caption="Deduplicate")
+        c.save_file("document.pdf", data)
+        c.mimetype = "application/pdf"
+        c.save()
+        return c
+
+    def testReleaseToZeroDeletesFile(self):
+        data = os.urandom(10000)
+        first, second = self.createContent(data), self.createContent(data)
+        path = first.file.path
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(Blob.objects.get(name=first.file.name).refcount, 2)
+        release_file(first.file)
+        self.assertTrue(os.path.isfile(path))
+        self.assertFalse(Blob.objects.exists())
+        release_file(second.file)
+        self.assertFalse(os.path.isfile(path))
+
+    def testSharingPreviewTwiceDoesNotLeak(self):
+        data = os.urandom(10000)
+        first, second = self.createContent(data), self.createContent(data)
+        first.preview.save(f"{first.id:09d}-{first.uid}-{thumbnail_postfix()}.png", ContentFile(b"png"))
+        self.assertTrue(second.share_preview())
+        self.assertTrue(second.share_preview())
+        self.assertEqual(second.preview.name, first.preview.name)
+        self.assertEqual(Blob.objects.get(name=first.preview.name).refcount, 2)
+        path = first.preview.path
+        release_file(second.preview)
+        self.assertTrue(os.path.isfile(path))
+        release_file(first.preview)
+        self.assertFalse(os.path.isfile(path))
+        for c in [first, second]:
+            release_file(c.file)
+
+    def testReleasingSharedInstanceKeepsFile(self):
+        data = os.urandom(10000)
+        first = self.createContent(data)
+        inst = Videoinstance(content=first, mimetype="video/webm", extension="webm")
+        inst.file.save(f"{first.id:09d}-{first.uid}.webm", ContentFile(b"webm"))
+        second = self.createContent(data)
+        self.assertEqual(second.share_instances(), 1)
+        shared = second.videoinstances.get()
+        self.assertEqual(shared.file.name, inst.file.name)
+        path = inst.file.path
+        release_file(inst.file)
+        self.assertTrue(os.path.isfile(path))
+        release_file(shared.file)
+        self.assertFalse(os.path.isfile(path))
+        for c in [first, second]:
+            release_file(c.file)
@@ -0,0 +1,25 @@
+import unittest
+
+from content import exifparser
+
+
+class TimezoneTestCase(unittest.TestCase):
+    def setUp(self):
+        exifparser._timezone_at.cache_clear()
+
+    def testFinderIsShared(self):
+        self.assertIs(exifparser.get_timezone_finder(), exifparser.get_timezone_finder())
+
+    def testTimezoneAt(self):
+        self.assertEqual(exifparser.timezone_at(60.1699, 24.9384), "Europe/Helsinki")
+        # A nearby location is rounded to the same cached lookup
+        exifparser.timezone_at(60.16992, 24.93841)
+        info = exifparser._timezone_at.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 1))
+
+    def testTimezonesAt(self):
+        points = [(60.1699, 24.9384), (40.7128, -74.0060), (60.1699, 24.9384), (35.6762, 139.6503)]
+        timezones = exifparser.timezones_at(points)
+        self.assertEqual(timezones, ["Europe/Helsinki", "America/New_York", "Europe/Helsinki", "Asia/Tokyo"])
+        self.assertEqual(exifparser._timezone_at.cache_info().misses, 3)
+        self.assertEqual(exifparser.timezones_at([]), [])
@@ -0,0 +1,46 @@
+import io
+
+from django.test import RequestFactory, SimpleTestCase
+
+from content.fileserving import parse_range_header, range_response
+
+
+class FileservingTestCase(SimpleTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.data = bytes(range(256)) * 4  # 1024 bytes
+
+    def testParseRangeHeader(self):
+        self.assertIsNone(parse_range_header(None, 1024))
+        self.assertIsNone(parse_range_header("items=0-1", 1024))
+        self.assertIsNone(parse_range_header("bytes=5-1", 1024))
+        self.assertEqual(parse_range_header("bytes=0-99", 1024), [(0, 99)])
+        self.assertEqual(parse_range_header("bytes=1000-", 1024), [(1000, 1023)])
+        self.assertEqual(parse_range_header("bytes=-24", 1024), [(1000, 1023)])
+        self.assertEqual(parse_range_header("bytes=0-0, 10-2000", 1024), [(0, 0), (10, 1023)])
+        self.assertEqual(parse_range_header("bytes=2000-3000", 1024), [])
+
+    def testSingleRange(self):
+        request = self.factory.get("/", HTTP_RANGE="bytes=100-199")
+        response = range_response(request, io.BytesIO(self.data), len(self.data), "video/mp4")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 100-199/1024")
+        self.assertEqual(b"".join(response.streaming_content), self.data[100:200])
+
+    def testMultipleRanges(self):
+        request = self.factory.get("/", HTTP_RANGE="bytes=0-9,-10")
+        response = range_response(request, io.BytesIO(self.data), len(self.data), "video/mp4")
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response["Content-Type"].startswith("multipart/byteranges"))
+        body = b"".join(response.streaming_content)
+        self.assertEqual(int(response["Content-Length"]), len(body))
+        self.assertIn(self.data[:10], body)
+        self.assertIn(self.data[-10:], body)
+
+    def testUnsatisfiableAndIfRange(self):
+        request = self.factory.get("/", HTTP_RANGE="bytes=5000-")
+        response = range_response(request, io.BytesIO(self.data), len(self.data), "video/mp4")
+        self.assertEqual(response.status_code, 416)
+        # If-Range with stale ETag returns the whole file
+        request = self.factory.get("/", HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE='"old"')
+        self.assertIsNone(range_response(request, io.BytesIO(self.data), len(self.data), "video/mp4", etag='"new"'))
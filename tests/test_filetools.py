@@ -1,8 +1,15 @@
+import concurrent.futures
+import io
 import os
+import tempfile
+from unittest import mock
 
+import PIL.Image
 from django.test import TestCase
 
 import content.filetools
+from content.probepool import ProbePool
+from content.profiles import DEFAULT_PROFILES, load_profiles, select_profiles
 
 TESTCONTENT_DIR = os.path.normpath(os.path.join(os.path.normpath(os.path.dirname(__file__)), "testfiles"))
 AUDIO_DIR = os.path.join(TESTCONTENT_DIR, "audio")
@@ -54,7 +61,7 @@ class FiletoolsTestCase(TestCase):
         for filename in files:
             cnt += 1
             path = os.path.join(testdir, filename)
-            new_video, cmd_str, output = content.filetools.create_videoinstance(path)
+            new_video, result = content.filetools.create_videoinstance(path)
             ffp = content.filetools.FFProbe(new_video)
             print(new_video, ffp.get_videoinfo())
             content.filetools.do_video_thumbnail(new_video, "/tmp/thumb.jpg")
@@ -62,3 +69,206 @@ class FiletoolsTestCase(TestCase):
             # self.assertTrue(ffp.is_video(), "Error '%s'" % filename)
             # self.assertFalse(ffp.is_audio(), "Error '%s'" % filename)
         print(f"Tested {cnt} video files")
+
+    def testFFMpegMultiOutputTranscode(self):
+        profiles = load_profiles(DEFAULT_PROFILES)
+        outputs = [(p.kind, p.ffmpeg_params(), p.ext) for p in select_profiles(profiles, "video")]
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        poster = os.path.join(tmpdir.name, "poster.jpg")
+        for filename in os.listdir(VIDEO_DIR):
+            path = os.path.join(VIDEO_DIR, filename)
+            content.filetools.CALL_COUNTER.clear()
+            result, results = content.filetools.transcode(path, outputs, thumbnail=poster)
+            self.assertTrue(result.ok)
+            self.assertEqual(result.command.count(" -i "), 1)
+            self.assertEqual(content.filetools.CALL_COUNTER["ffprobe"], len(outputs))
+            for new_video, info in results:
+                self.assertGreater(info.get("height", 0), 0, result.command)
+                os.unlink(new_video)
+            self.assertTrue(os.path.isfile(poster))
+            os.unlink(poster)
+
+
+class ProfilesTestCase(TestCase):
+    def testSelectProfilesSkipsUpscales(self):
+        config = DEFAULT_PROFILES + [
+            {
+                "name": "mp4_720",
+                "kind": "video",
+                "ext": "mp4",
+                "mimetype": "video/mp4",
+                "codec": "libx264",
+                "height": 720,
+            }
+        ]
+        profiles = load_profiles(config)
+        names = [p.name for p in select_profiles(profiles, "video", 1080)]
+        self.assertEqual(names, ["webm", "mp4", "mp4_720"])
+        names = [p.name for p in select_profiles(profiles, "video", 480)]
+        self.assertEqual(names, ["webm", "mp4"])
+        # Too small source is encoded in its own size instead of upscaling
+        selected = select_profiles(profiles, "video", 240)
+        self.assertEqual([p.name for p in selected], ["webm", "mp4"])
+        self.assertIn("scale=trunc(oh*a/2)*2:240", selected[0].ffmpeg_params(240))
+        self.assertEqual([p.name for p in select_profiles(profiles, "audio")], ["ogg", "mp3"])
+
+    def testDefaultProfileComesFromConfiguredProfiles(self):
+        config = [
+            {
+                "name": "mp4_480",
+                "kind": "video",
+                "ext": "mp4",
+                "mimetype": "video/mp4",
+                "codec": "libx264",
+                "height": 480,
+            }
+        ]
+        with mock.patch("content.filetools.configured_profiles", return_value=load_profiles(config)):
+            self.assertEqual(content.filetools.default_profile("video").name, "mp4_480")
+            self.assertEqual(content.filetools.default_profile("video", "webm").name, "mp4_480")
+            with self.assertRaises(ValueError):
+                content.filetools.default_profile("audio")
+
+    def testDefaultInstanceProfiles(self):
+        with mock.patch("content.filetools.configured_profiles", return_value=load_profiles(DEFAULT_PROFILES)):
+            self.assertEqual(content.filetools.default_profile("video", "webm").name, "webm")
+            self.assertEqual(content.filetools.default_profile("audio", "mp3").name, "mp3")
+            self.assertEqual(content.filetools.default_profile("audio", "webm").name, "ogg")
+
+
+class RunnerTestCase(TestCase):
+    def testTimeoutKillsCommand(self):
+        result = content.filetools.run_command(["sleep", "10"], timeout=0.5)
+        self.assertTrue(result.timed_out)
+        self.assertFalse(result.ok)
+        self.assertLess(result.elapsed, 5)
+        result = content.filetools.run_command(["false"])
+        self.assertEqual(result.returncode, 1)
+        self.assertFalse(result.ok)
+
+    def testLimitsAreApplied(self):
+        base = os.nice(0)
+        result = content.filetools.run_command(["nice"])  # Prints the niceness of itself
+        self.assertEqual(int(result.stdout), min(base + content.filetools.RUNNER_LIMITS["nice"], 19))
+        with self.assertRaises(OSError):
+            content.filetools.run_command(["no-such-command-here"])
+
+    def testParseFFMpegStats(self):
+        stderr = (
+            "frame=   48 fps=0.0 q=-0.0 size=N/A time=00:00:01.92 bitrate=N/A speed=3.8x\r"
+            "frame=  250 fps=120 q=-0.0 Lsize=N/A time=00:01:10.00 bitrate=N/A speed=4.16x\n"
+        )
+        stats = content.filetools.parse_ffmpeg_stats(stderr)
+        self.assertEqual(stats, {"frames": 250, "fps": 120.0, "speed": 4.16, "time": 70.0})
+
+
+class InlineExecutor:
+    """
+    Run ProbePool's jobs in this process, so that CALL_COUNTER and mocks see them.
+    """
+
+    def submit(self, fn, *args):
+        future = concurrent.futures.Future()
+        future.set_result(fn(*args))
+        return future
+
+    def shutdown(self):
+        pass
+
+
+class ProbePoolTestCase(TestCase):
+    def testPoolReturnsSameResults(self):
+        files = [os.path.join(AUDIO_DIR, f) for f in os.listdir(AUDIO_DIR)]
+        with ProbePool(workers=2) as pool:
+            results = dict(pool.probe_files(files))
+            self.assertEqual(pool.mimetype(files[0]), content.filetools.get_mimetype(files[0]))
+        self.assertEqual(set(results), set(files))
+        for path, (mimetype, ffp) in results.items():
+            self.assertEqual(mimetype, content.filetools.get_mimetype(path))
+            self.assertEqual(ffp.get_audioinfo(), content.filetools.FFProbe(path).get_audioinfo())
+
+    def testFileProbeUsesPool(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "red.png")
+            PIL.Image.new("RGB", (64, 48), "red").save(path)
+            with ProbePool(workers=1) as pool, mock.patch.object(content.filetools.FileProbe, "pool", pool):
+                content.filetools.CALL_COUNTER.clear()
+                probe = content.filetools.FileProbe(path)
+                self.assertEqual(probe.mimetype, "image/png")
+                self.assertEqual(probe.ffprobe.data, content.filetools.FFProbe(path).data)
+                # Only the comparison FFProbe above ran in this process
+                self.assertEqual(content.filetools.CALL_COUNTER["ffprobe"], 1)
+
+    def testFileProbeRunsToolsOnceInPool(self):
+        pool = ProbePool(workers=1)
+        pool.executor = InlineExecutor()
+        files = [os.path.join(VIDEO_DIR, f) for f in os.listdir(VIDEO_DIR)]
+        get_mimetype = mock.Mock(wraps=content.filetools.get_mimetype)
+        with mock.patch.object(content.filetools.FileProbe, "pool", pool):
+            with mock.patch("content.filetools.get_mimetype", get_mimetype):
+                for path in files:
+                    get_mimetype.reset_mock()
+                    content.filetools.CALL_COUNTER.clear()
+                    probe = content.filetools.FileProbe(path)
+                    self.assertTrue(probe.mimetype.startswith("video/"))
+                    self.assertTrue(probe.ffprobe.is_video())
+                    self.assertEqual(get_mimetype.call_count, 1)
+                    self.assertEqual(content.filetools.CALL_COUNTER["ffprobe"], 1)
+
+
+class MimetypeTestCase(TestCase):
+    def testSignaturesAgreeWithLibmagic(self):
+        samples = [
+            b"\xff\xd8\xff\xe0\x00\x10JFIF\x00",
+            b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR",
+            b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n",
+            b"\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom",
+            b"\x00\x00\x00\x18ftyp3gp4\x00\x00\x00\x003gp4isom",
+            b"\x00\x00\x00\x18ftypheic\x00\x00\x00\x00mif1heic",
+        ]
+        for buf in samples:
+            mimetype = content.filetools.get_mimetype_from_signature(buf)
+            self.assertIsNotNone(mimetype, buf)
+            self.assertEqual(mimetype, content.filetools.get_magic().from_buffer(buf), buf)
+        self.assertIsNone(content.filetools.get_mimetype_from_signature(b"plain text"))
+        self.assertEqual(content.filetools.get_mimetype_from_buffer(b"plain text"), "text/plain")
+
+    def testMediatype(self):
+        expected = {
+            "image/heic": "image",
+            "video/3gpp": "video",
+            "audio/mpeg": "audio",
+            "application/pdf": "document",
+            "text/plain": "document",
+            "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "document",
+            "application/zip": "other",
+            None: "other",
+        }
+        for mimetype, mediatype in expected.items():
+            self.assertEqual(content.filetools.get_mediatype(mimetype), mediatype, mimetype)
+
+
+class ScaleImageTestCase(TestCase):
+    def testDraftScaling(self):
+        buf = io.BytesIO()
+        PIL.Image.new("RGB", (4000, 3000), "red").save(buf, "jpeg")
+        buf.seek(0)
+        im = PIL.Image.open(buf)
+        scaled = content.filetools.scale_image(im, (400, 200), rotate=90)
+        # Image is scaled to fit the box after rotation
+        self.assertEqual(scaled.size, (150, 200))
+        # JPEG was decoded in reduced size, decoderconfig is (scale, 0)
+        self.assertGreater(im.decoderconfig[0], 1)
+        buf.seek(0)
+        im = PIL.Image.open(buf)
+        scaled = content.filetools.scale_image(im, (400, 200), reducing_gap=None)
+        self.assertEqual(scaled.size, (267, 200))
+        self.assertEqual(im.decoderconfig, ())
+
+    def testDownscaleLevels(self):
+        im = PIL.Image.new("RGB", (1600, 1200), "red")
+        levels = content.filetools.downscale_levels(im, [640, 160, 320, 1600, 2000])
+        self.assertEqual([size for size, level in levels], [160, 320, 640])
+        self.assertEqual([level.size for size, level in levels], [(160, 120), (320, 240), (640, 480)])
+        self.assertEqual(im.size, (1600, 1200))
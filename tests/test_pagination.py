@@ -0,0 +1,70 @@
+import datetime
+
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from content import views
+from content.models import Content
+from content.pagination import decode_cursor, encode_cursor
+
+
+@override_settings(ROOT_URLCONF="content.urls")
+class KeysetPaginationTestCase(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.view = views.ContentViewSet.as_view({"get": "list"})
+        now = timezone.now()
+        for i in range(7):
+            mimetype = "video/mp4" if i % 2 else "image/jpeg"
+            c = Content.objects.create(
+                caption=f"Page {i}", originalfilename=f"file{i}", mimetype=mimetype, mediatype=mimetype.split("/")[0]
+            )
+            # Every second pair has the same timestamp, cursor must not skip or repeat them
+            Content.objects.filter(pk=c.pk).update(created=now - datetime.timedelta(minutes=i // 2))
+
+    def fetchAll(self, url):
+        uids = []
+        while url:
+            with self.assertNumQueries(2):  # Contents and their videoinstances
+                response = self.view(self.factory.get(url))
+                response.render()
+            self.assertNotIn("count", response.data)
+            uids += [item["uid"] for item in response.data["results"]]
+            url = response.data["next"]
+        return uids
+
+    def testPagesAreComplete(self):
+        expected = list(Content.objects.order_by("-created", "-id").values_list("uid", flat=True))
+        for page_size in [1, 2, 3, 7, 100]:
+            self.assertEqual(self.fetchAll(f"/?page_size={page_size}"), expected)
+
+    def testFilters(self):
+        expected = list(
+            Content.objects.filter(mimetype__startswith="video/")
+            .order_by("-created", "-id")
+            .values_list("uid", flat=True)
+        )
+        self.assertEqual(self.fetchAll("/?page_size=2&mimetype=video"), expected)
+        tomorrow = (timezone.now() + datetime.timedelta(days=1)).date().isoformat()
+        self.assertEqual(self.fetchAll(f"/?created_after={tomorrow}"), [])
+        response = self.view(self.factory.get("/?created_before=yesterday"))
+        self.assertEqual(response.status_code, 400)
+
+    def testCount(self):
+        response = self.view(self.factory.get("/?page_size=2&count=true"))
+        self.assertEqual(response.data["count"], 7)
+        self.assertEqual(len(response.data["results"]), 2)
+
+    def testCursorIsIndexRangeCondition(self):
+        first = self.view(self.factory.get("/?page_size=3")).data
+        with CaptureQueriesContext(connection) as queries:
+            self.view(self.factory.get(first["next"]))
+        sql = queries.captured_queries[0]["sql"]
+        self.assertRegex(sql, r'"content_content"\."created" <= ')
+
+    def testCursor(self):
+        created = timezone.now()
+        self.assertEqual(decode_cursor(encode_cursor(created, 42)), (created, 42))
+        self.assertEqual(self.view(self.factory.get("/?cursor=broken")).status_code, 404)
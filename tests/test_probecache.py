@@ -0,0 +1,40 @@
+import os
+import tempfile
+import time
+import unittest
+
+from content.probecache import ProbeCache
+
+
+class ProbeCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = ProbeCache(os.path.join(self.tmpdir.name, "probe.sqlite3"), max_entries=10)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def testPutAndGet(self):
+        self.assertIsNone(self.cache.get("sha1:abc"))
+        self.cache.put("sha1:abc", {"streams": [{"codec_type": "audio"}]})
+        self.assertEqual(self.cache.get("sha1:abc"), {"streams": [{"codec_type": "audio"}]})
+
+    def testFileKeyChangesWithFile(self):
+        path = os.path.join(self.tmpdir.name, "a.mp3")
+        self.assertIsNone(self.cache.file_key(path))
+        with open(path, "wb") as f:
+            f.write(b"abc")
+        key = self.cache.file_key(path)
+        with open(path, "ab") as f:
+            f.write(b"def")
+        self.assertNotEqual(self.cache.file_key(path), key)
+        self.assertEqual(self.cache.file_key(path, sha1="abc"), "sha1:abc")
+
+    def testEviction(self):
+        for i in range(15):
+            self.cache.put(f"key{i}", {"i": i})
+        time.sleep(0.01)
+        self.cache.get("key0")  # Recently used entries are kept
+        self.assertGreater(self.cache.evict(), 0)
+        self.assertEqual(self.cache.get("key0"), {"i": 0})
+        self.assertIsNone(self.cache.get("key1"))
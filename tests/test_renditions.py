@@ -0,0 +1,41 @@
+import datetime
+import os
+import tempfile
+import unittest
+
+from content.renditions import RenditionCache
+
+
+class RenditionCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = RenditionCache(self.tmpdir.name, max_size=1000)
+        self.updated = datetime.datetime(2022, 4, 23, 13, 41, tzinfo=datetime.timezone.utc)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def testPutAndGet(self):
+        key = self.cache.key(640, 480, "-crop", "jpeg", self.updated)
+        self.assertIsNone(self.cache.get("abcdef", key))
+        self.cache.put("abcdef", key, b"data")
+        self.assertEqual(self.cache.get("abcdef", key), b"data")
+        # Newer Content.updated must not return old rendition
+        newer = self.cache.key(640, 480, "-crop", "jpeg", self.updated + datetime.timedelta(seconds=1))
+        self.assertIsNone(self.cache.get("abcdef", newer))
+
+    def testInvalidate(self):
+        key = self.cache.key(160, 160, None, "png", self.updated)
+        self.cache.put("abcdef", key, b"data")
+        self.cache.invalidate("abcdef")
+        self.assertIsNone(self.cache.get("abcdef", key))
+
+    def testEviction(self):
+        keys = [self.cache.key(i, i, None, "jpeg", self.updated) for i in range(1, 6)]
+        for i, key in enumerate(keys):
+            self.cache.put("abcdef", key, b"x" * 300)
+            os.utime(self.cache.path("abcdef", key), (i, i))
+        self.cache.evict()
+        # Oldest renditions are removed first
+        self.assertIsNone(self.cache.get("abcdef", keys[0]))
+        self.assertIsNotNone(self.cache.get("abcdef", keys[-1]))
@@ -0,0 +1,187 @@
+import io
+from unittest import mock
+
+import PIL.Image
+from django.core.files.base import ContentFile
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from content import views
+from content.models import Content, Videoinstance, release_file
+
+
+class PreviewFormatTestCase(SimpleTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def testAcceptedTypes(self):
+        accept = "image/avif,image/webp;q=0.9,image/apng,image/*;q=0.8,*/*;q=0.5,image/png;q=0"
+        self.assertEqual(views._accepted_types(accept), {"image/avif", "image/webp", "image/apng"})
+
+    def testNegotiation(self):
+        chrome = self.factory.get("/", HTTP_ACCEPT="image/avif,image/webp,image/apng,image/*,*/*;q=0.8")
+        old = self.factory.get("/", HTTP_ACCEPT="image/png,image/*;q=0.8,*/*;q=0.5")
+        expected = views.NEGOTIATED_FORMATS[0] if views.NEGOTIATED_FORMATS else "jpeg"
+        self.assertEqual(views._preview_format(chrome, None, "jpg")[0], expected)
+        self.assertEqual(views._preview_format(old, None, "jpg")[0], "jpeg")
+        # Explicit extension is honored regardless of Accept
+        self.assertEqual(views._preview_format(chrome, None, "png"), ("png", False))
+
+
+def png_data(color: str) -> bytes:
+    f = io.BytesIO()
+    PIL.Image.new("RGB", (320, 240), color).save(f, "png")
+    return f.getvalue()
+
+
+@override_settings(ROOT_URLCONF="content.urls")
+class ConditionalGetTestCase(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.content = Content(caption="Conditional", originalfilename="photo.png")
+        self.content.save_file("photo.png", png_data("red"))
+        self.content.mimetype = "image/png"
+        self.content.save()
+        self.setPreview("red")
+        self.inst = Videoinstance(content=self.content, mimetype="video/mp4", extension="mp4", filesize=4)
+        self.inst.file.save("instance.mp4", ContentFile(b"mp4!"))
+
+    def tearDown(self):
+        for fieldfile in [self.content.file, self.content.preview, self.inst.file]:
+            release_file(fieldfile)
+
+    def setPreview(self, color: str):
+        release_file(self.content.preview)
+        self.content.preview.save("preview.png", ContentFile(png_data(color)))
+        self.content.save()
+
+    def get(self, view, etag=None, accept="image/png", **kwargs):
+        headers = {"HTTP_IF_NONE_MATCH": etag} if etag else {}
+        response = view(self.factory.get("/", HTTP_ACCEPT=accept, **headers), self.content.uid, **kwargs)
+        if getattr(response, "file_to_stream", None):
+            response.file_to_stream.close()
+        return response
+
+    def checkNotModified(self, view, **kwargs):
+        response = self.get(view, **kwargs)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        response = self.get(view, etag=etag, **kwargs)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        self.assertIn("no-cache", response["Cache-Control"])
+        self.assertEqual(self.get(view, etag='"other"', **kwargs).status_code, 200)
+        return etag
+
+    def testNotModified(self):
+        self.checkNotModified(views.preview, width=160, height=160, ext="png")
+        self.assertEqual(self.checkNotModified(views.original, filename="photo.png"), f'"{self.content.sha1}"')
+        self.checkNotModified(views.instance, extension="mp4")
+
+    def testPreviewEtagChangesWhenPreviewIsRegenerated(self):
+        etag = self.checkNotModified(views.preview, width=160, height=160, ext="png")
+        self.setPreview("blue")
+        response = self.get(views.preview, width=160, height=160, ext="png", etag=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(PIL.Image.open(io.BytesIO(response.content)).getpixel((0, 0)), (0, 0, 255))
+
+    def testCacheHeaders(self):
+        responses = [
+            self.get(views.preview, width=160, height=160, ext="png"),
+            self.get(views.original, filename="photo.png"),
+            self.get(views.instance, extension="mp4"),
+        ]
+        for response in responses:
+            self.assertIn("no-cache", response["Cache-Control"])
+            self.assertNotIn("Accept", response.get("Vary", ""))
+        with mock.patch("content.views.CACHE_CONTROL", {"max_age": 3600}):
+            response = self.get(views.original, filename="photo.png")
+            self.assertEqual(response["Cache-Control"], "max-age=3600")
+
+    @mock.patch("content.views.NEGOTIATED_FORMATS", ["webp"])
+    def testVaryAccept(self):
+        # Negotiated preview format depends on Accept, so also 304 response must vary by it
+        accept = "image/webp,*/*"
+        response = self.get(views.preview, width=160, height=160, ext="jpg", accept=accept)
+        self.assertEqual(response["Content-Type"], "image/webp")
+        self.assertIn("Accept", response["Vary"])
+        response = self.get(views.preview, width=160, height=160, ext="jpg", accept=accept, etag=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+        self.assertIn("Accept", response["Vary"])
+        # Explicit extension is not negotiated
+        self.assertNotIn("Vary", self.get(views.preview, width=160, height=160, ext="png", accept=accept))
+
+
+@override_settings(ROOT_URLCONF="content.urls")
+class ContentListQueryTestCase(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.view = views.ContentViewSet.as_view({"get": "list"}, pagination_class=None)
+
+    def createContents(self, count):
+        for i in range(count):
+            c = Content.objects.create(caption=f"List {i}", originalfilename=f"video{i}.mp4", mimetype="video/mp4")
+            for ext in ["mp4", "webm"]:
+                Videoinstance.objects.create(content=c, mimetype=f"video/{ext}", extension=ext)
+
+    def testQueryCountDoesNotDependOnPageSize(self):
+        for count in [1, 10]:
+            Content.objects.all().delete()
+            self.createContents(count)
+            with self.assertNumQueries(2):
+                response = self.view(self.factory.get("/"))
+                response.render()
+            self.assertEqual(len(response.data), count)
+            self.assertEqual(len(response.data[0]["videoinstances"]), 2)
+
+
+@override_settings(ROOT_URLCONF="content.urls")
+class GeoQueryTestCase(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        # Three photos in Helsinki and one in Tampere
+        for i, (lat, lon) in enumerate(
+            [(60.1699, 24.9384), (60.1700, 24.9390), (60.1710, 24.9410), (61.4978, 23.7610)]
+        ):
+            c = Content(caption=f"Geo {i}", originalfilename=f"photo{i}.jpg", mimetype="image/jpeg")
+            c.set_latlon(lat, lon)
+            c.save()
+
+    def testBboxAndRadius(self):
+        view = views.ContentViewSet.as_view({"get": "list"})
+        response = view(self.factory.get("/?bbox=24.5,60.0,25.5,60.5"))
+        self.assertEqual(len(response.data["results"]), 3)
+        response = view(self.factory.get("/?lat=60.1699&lon=24.9384&radius=100"))
+        self.assertEqual(len(response.data["results"]), 2)
+        invalid = [
+            "radius=100",
+            "bbox=24.5,60.0",
+            "bbox=nan,60.0,25.5,60.5",
+            "bbox=25.5,60.0,24.5,60.5",
+            "bbox=24.5,-100,25.5,60.5",
+            "lat=60.1699&lon=24.9384&radius=-1",
+            "lat=60.1699&lon=inf&radius=100",
+        ]
+        for query in invalid:
+            self.assertEqual(view(self.factory.get(f"/?{query}")).status_code, 400, query)
+
+    def testClusters(self):
+        view = views.ContentViewSet.as_view({"get": "clusters"})
+        response = view(self.factory.get("/?zoom=5&bbox=20,55,30,65"))
+        self.assertEqual(response.data["count"], 4)
+        counts = sorted(c["count"] for c in response.data["clusters"])
+        self.assertEqual(counts, [1, 3])
+        single = [c for c in response.data["clusters"] if c["count"] == 1][0]
+        self.assertIn("uid", single)
+        response = view(self.factory.get("/?zoom=5&bbox=24.5,60.0,25.5,60.5"))
+        self.assertEqual(response.data["count"], 3)
+        self.assertEqual(view(self.factory.get("/")).status_code, 400)
+        # Without bbox the whole world would be thousands of cells at high zoom levels
+        self.assertEqual(view(self.factory.get("/?zoom=22")).status_code, 400)
+        self.assertEqual(view(self.factory.get("/?zoom=18&bbox=-180,-90,180,90")).status_code, 400)
+        self.assertEqual(view(self.factory.get("/?zoom=2")).status_code, 200)
+
+    def testCountCells(self):
+        self.assertLessEqual(views.count_cells(views.WORLD_BBOX, 3), views.MAX_CLUSTERS)
+        self.assertGreater(views.count_cells(views.WORLD_BBOX, 22), views.MAX_CLUSTERS)
+        self.assertEqual(views.count_cells((0, 0, 0, 0), 22), 1)
@@ -1,22 +1,217 @@
 from __future__ import annotations
 
+import datetime
+import hashlib
 import io
 import logging
+import math
 import os
 
 import PIL.Image
 from PIL import ImageDraw, ImageFont
+from django.conf import settings
+from django.contrib.gis.db.models import Collect
+from django.contrib.gis.db.models.functions import Centroid, SnapToGrid
+from django.contrib.gis.geos import Point, Polygon
+from django.contrib.gis.measure import D
+from django.db import transaction
+from django.db.models import Count, Min, Prefetch
 from django.http import Http404, HttpResponse, FileResponse
+from django.http.response import HttpResponseBase
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.http import http_date, quote_etag
+from django.utils.timezone import make_aware
 from rest_framework import mixins, viewsets
 from rest_framework import parsers
-from rest_framework.decorators import api_view
+from rest_framework.decorators import action, api_view
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 
 # from rest_framework import permissions
 
-from content.models import Content
+from content.fileserving import range_response, sendfile_response
+from content.filetools import MEDIATYPES
+from content.models import ASYNC_INGEST, AVAILABLE_FORMATS, Content, Videoinstance, rendition_cache
+from content.models import STORAGES
+from content.pagination import KeysetPagination
 from content.serializers import ContentSerializer
 
+# Storages whose files are sent by the web server, see content.fileserving
+SENDFILE = getattr(settings, "CONTENT_SENDFILE", {})
+# Cache-Control of preview, original and instance responses, as patch_cache_control() keyword arguments.
+# URLs stay the same when a preview is regenerated, so by default caches must revalidate with the ETag.
+CACHE_CONTROL = getattr(settings, "CONTENT_CACHE_CONTROL", {"no_cache": True})
+STORAGE_LOCATIONS = {name: storage.location for name, storage in STORAGES.items()}
+# Clusters are cells of a grid, which has this many cells per side of a map tile at the given zoom level
+CLUSTER_CELLS_PER_TILE = getattr(settings, "CONTENT_CLUSTER_CELLS_PER_TILE", 4)
+MAX_CLUSTER_ZOOM = 22
+# Max number of grid cells a clusters request may cover, a smaller bbox or zoom is needed for more
+MAX_CLUSTERS = getattr(settings, "CONTENT_MAX_CLUSTERS", 5000)
+WORLD_BBOX = (-180.0, -90.0, 180.0, 90.0)
+
+
+# Columns ContentSerializer uses, legacy text columns and point_geom are not loaded in list
+CONTENT_LIST_FIELDS = [
+    "id",
+    "uid",
+    "title",
+    "caption",
+    "author",
+    "originalfilename",
+    "preview",
+    "filesize",
+    "filetime",
+    "sha1",
+    "point",
+    "mimetype",
+    "status",
+    "created",
+    "updated",
+]
+VIDEOINSTANCE_LIST_FIELDS = [
+    "id",
+    "content_id",
+    "mimetype",
+    "filesize",
+    "duration",
+    "bitrate",
+    "extension",
+    "width",
+    "height",
+    "framerate",
+    "created",
+]
+
+
+def _parse_time_param(name: str, value: str):
+    dt = parse_datetime(value)
+    if dt is None:
+        d = parse_date(value)
+        if d is None:
+            raise ValidationError({name: f"Invalid date or timestamp: {value}"})
+        dt = datetime.datetime.combine(d, datetime.time())
+    return make_aware(dt) if dt.tzinfo is None else dt
+
+
+def _parse_floats_param(name: str, value: str, count: int) -> list[float]:
+    try:
+        values = [float(v) for v in value.split(",")]
+    except ValueError:
+        values = []
+    if len(values) != count or not all(math.isfinite(v) for v in values):
+        raise ValidationError({name: f"{name} must be {count} comma separated finite numbers"})
+    return values
+
+
+def _parse_latlon(lat: float, lon: float, name: str):
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValidationError({name: "Latitude must be between -90 and 90 and longitude between -180 and 180"})
+
+
+def parse_bbox(params) -> tuple[float, float, float, float] | None:
+    """
+    Return bbox=min_lon,min_lat,max_lon,max_lat parameter as a tuple or None if it is not given.
+    """
+    if not params.get("bbox"):
+        return None
+    min_lon, min_lat, max_lon, max_lat = _parse_floats_param("bbox", params["bbox"], 4)
+    _parse_latlon(min_lat, min_lon, "bbox")
+    _parse_latlon(max_lat, max_lon, "bbox")
+    if min_lon > max_lon or min_lat > max_lat:
+        raise ValidationError({"bbox": "bbox minimums must not be greater than maximums"})
+    return min_lon, min_lat, max_lon, max_lat
+
+
+def filter_location(queryset, params):
+    """
+    Filter Contents by location:
+    bbox=min_lon,min_lat,max_lon,max_lat uses point_geom's GiST index (&& operator),
+    lat, lon and radius (in meters) use point's geography GiST index (ST_DWithin).
+    """
+    bbox = parse_bbox(params)
+    if bbox:
+        polygon = Polygon.from_bbox(bbox)
+        polygon.srid = 4326
+        queryset = queryset.filter(point_geom__bboverlaps=polygon)
+    if params.get("radius"):
+        radius = _parse_floats_param("radius", params["radius"], 1)[0]
+        if radius <= 0:
+            raise ValidationError({"radius": "radius must be positive"})
+        if not params.get("lat") or not params.get("lon"):
+            raise ValidationError({"radius": "lat and lon are required with radius"})
+        lat = _parse_floats_param("lat", params["lat"], 1)[0]
+        lon = _parse_floats_param("lon", params["lon"], 1)[0]
+        _parse_latlon(lat, lon, "radius")
+        queryset = queryset.filter(point__dwithin=(Point(lon, lat, srid=4326), D(m=radius)))
+    return queryset
+
+
+def cluster_cell_size(zoom: int) -> float:
+    return 360.0 / (2**zoom) / CLUSTER_CELLS_PER_TILE
+
+
+def count_cells(bbox: tuple, zoom: int) -> int:
+    """
+    Return the max number of grid cells, which bbox may cover at zoom level `zoom`.
+    """
+    cell_size = cluster_cell_size(zoom)
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return (math.ceil((max_lon - min_lon) / cell_size) + 1) * (math.ceil((max_lat - min_lat) / cell_size) + 1)
+
+
+def cluster_contents(queryset, zoom: int, limit: int = MAX_CLUSTERS) -> list[dict]:
+    """
+    Group located Contents to grid cells, whose size depends on map zoom level,
+    and return the number of Contents and their center point per cell.
+    uid is the uid of a Content if the cell has only one.
+    At most `limit` cells are returned.
+    """
+    cells = (
+        queryset.filter(point_geom__isnull=False)
+        .order_by()  # Ordering columns would be added to GROUP BY
+        .annotate(cell=SnapToGrid("point_geom", cluster_cell_size(zoom)))
+        .values("cell")
+        .annotate(count=Count("id"), center=Centroid(Collect("point_geom")), uid=Min("uid"))
+    )
+    clusters = []
+    for cell in cells[:limit]:
+        cluster = {"lat": round(cell["center"].y, 6), "lon": round(cell["center"].x, 6), "count": cell["count"]}
+        if cell["count"] == 1:
+            cluster["uid"] = cell["uid"]
+        clusters.append(cluster)
+    return clusters
+
+
+def filter_contents(queryset, params):
+    """
+    Filter Contents with list API's query parameters:
+    mimetype (mediatype like "video", other major type or full mimetype), status, privacy, user (id),
+    created_after and created_before (ISO date or timestamp, after is inclusive)
+    and location (see filter_location()).
+    """
+    mimetype = params.get("mimetype")
+    if mimetype:
+        if "/" in mimetype:
+            queryset = queryset.filter(mimetype=mimetype)
+        elif mimetype in MEDIATYPES:
+            queryset = queryset.filter(mediatype=mimetype)
+        else:
+            queryset = queryset.filter(mimetype__startswith=f"{mimetype}/")
+    for name in ["status", "privacy"]:
+        if params.get(name):
+            queryset = queryset.filter(**{name: params[name]})
+    if params.get("user"):
+        try:
+            queryset = queryset.filter(user_id=int(params["user"]))
+        except ValueError:
+            raise ValidationError({"user": "User must be an integer id"})
+    if params.get("created_after"):
+        queryset = queryset.filter(created__gte=_parse_time_param("created_after", params["created_after"]))
+    if params.get("created_before"):
+        queryset = queryset.filter(created__lt=_parse_time_param("created_before", params["created_before"]))
+    return filter_location(queryset, params)
+
 
 # TODO: add authentication and authorization
 
@@ -26,12 +221,45 @@ class ContentViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
     API endpoint that allows Contents to be created, viewed or edited.
     """
 
-    queryset = Content.objects.all().order_by("-created")
+    queryset = Content.objects.all().order_by("-created", "-id")
     serializer_class = ContentSerializer
+    pagination_class = KeysetPagination
     parser_classes = [parsers.MultiPartParser, parsers.FormParser, parsers.FileUploadParser]
 
     # permission_classes = [permissions.IsAuthenticated]
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == "list":
+            # Fetch a page with two queries regardless of page size: contents and their videoinstances
+            videoinstances = Videoinstance.objects.only(*VIDEOINSTANCE_LIST_FIELDS).order_by("id")
+            queryset = queryset.only(*CONTENT_LIST_FIELDS).prefetch_related(
+                Prefetch("videoinstances", queryset=videoinstances)
+            )
+        return queryset
+
+    def filter_queryset(self, queryset):
+        return filter_contents(super().filter_queryset(queryset), self.request.query_params)
+
+    @action(detail=False, methods=["get"])
+    def clusters(self, request):
+        """
+        Return counts of located Contents per grid cell instead of every Content,
+        e.g. clusters/?zoom=12&bbox=24.8,60.1,25.1,60.3
+        All list filters can be used.
+        """
+        try:
+            zoom = int(request.query_params["zoom"])
+        except (KeyError, ValueError):
+            raise ValidationError({"zoom": "zoom must be an integer"})
+        if not 0 <= zoom <= MAX_CLUSTER_ZOOM:
+            raise ValidationError({"zoom": f"zoom must be between 0 and {MAX_CLUSTER_ZOOM}"})
+        # Too many cells would be almost every point, which clustering is meant to avoid
+        if count_cells(parse_bbox(request.query_params) or WORLD_BBOX, zoom) > MAX_CLUSTERS:
+            raise ValidationError({"bbox": f"bbox covers more than {MAX_CLUSTERS} cells, use a smaller bbox or zoom"})
+        clusters = cluster_contents(self.filter_queryset(self.get_queryset()), zoom)
+        return Response({"zoom": zoom, "count": sum(c["count"] for c in clusters), "clusters": clusters})
+
     def post(self, request):
         if "file" not in request.data:
             return Response("'file' argument is missing", status=400)
@@ -46,6 +274,13 @@ class ContentViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         c: Content = serializer.save()
+        if ASYNC_INGEST:
+            # Store only the bytes here, metadata and thumbnail are created in the background
+            from content.tasks import process_content_task
+
+            c.save_file(f.name, f)
+            transaction.on_commit(lambda: process_content_task.delay(c.pk))
+            return Response(serializer.data, status=202)
         c.set_file(f.name, f)
         c.set_fileinfo()
         c.generate_thumbnail()
@@ -76,54 +311,105 @@ def _get_placeholder_instance(c, text=None):
     return im
 
 
-@api_view(("GET", "HEAD"))
-def preview(request, uid: str, width: int | str, height: int | str, action=None, ext=None):
+PREVIEW_MIMETYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp", "avif": "image/avif"}
+# Encoder options per preview format, WebP and AVIF are tuned for encoding speed.
+# Every rendition is encoded only once and then served from rendition_cache.
+PREVIEW_ENCODERS = {
+    "jpeg": {"quality": 90},
+    "png": {},
+    "webp": {"quality": 80, "method": 0},
+    "avif": {"quality": 60, "enc_params": {"speed": "9"}},
+}
+PREVIEW_EXTENSIONS = {"jpg": "jpeg", "jpeg": "jpeg", "png": "png", "webp": "webp", "avif": "avif"}
+# Formats which are sent to clients that accept them, in order of preference
+NEGOTIATED_FORMATS = [
+    fmt for fmt in getattr(settings, "CONTENT_PREVIEW_FORMATS", ["avif", "webp"]) if fmt in AVAILABLE_FORMATS
+]
+
+
+def _accepted_types(accept: str) -> set[str]:
     """
-    Return scaled JPEG/PNG instance of the Content, which has a preview available
-    New size is determined from URL.
-    action can be '-crop'
+    Return mimetypes which are explicitly accepted in an Accept header (wildcards and q=0 are ignored).
+    """
+    accepted = set()
+    for item in accept.split(","):
+        mimetype, *params = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0 and "*" not in mimetype:
+            accepted.add(mimetype.lower())
+    return accepted
+
+
+def _preview_format(request, thumbnail, ext: str | None) -> tuple[str, bool]:
+    """
+    Return preview's format and True if it was negotiated from Accept header.
+    Explicit .webp, .avif and .png extensions are always honored, otherwise
+    the first accepted format of NEGOTIATED_FORMATS is used, and finally
+    JPEG or PNG like the thumbnail itself.
+    """
+    fmt = PREVIEW_EXTENSIONS.get((ext or "").lower())
+    if fmt in ("webp", "avif", "png") and fmt in AVAILABLE_FORMATS:
+        return fmt, False
+    if NEGOTIATED_FORMATS:
+        accepted = _accepted_types(request.META.get("HTTP_ACCEPT", ""))
+        for fmt in NEGOTIATED_FORMATS:
+            if PREVIEW_MIMETYPES[fmt] in accepted:
+                return fmt, True
+    if thumbnail and thumbnail.name.endswith("png"):
+        return "png", bool(NEGOTIATED_FORMATS)
+    return "jpeg", bool(NEGOTIATED_FORMATS)
+
+
+def _conditional_response(request, etag: str | None, last_modified: int | None = None) -> HttpResponse | None:
+    """
+    Return 304 Not Modified (or 412 Precondition Failed) response if request's
+    If-None-Match / If-Modified-Since etc. headers match, otherwise None.
+    """
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        if etag:
+            response["ETag"] = etag
+        if last_modified:
+            response["Last-Modified"] = http_date(last_modified)
+    return response
+
+
+def _patch_cache_headers(response: HttpResponseBase, negotiated: bool = False) -> HttpResponseBase:
+    """
+    Add Cache-Control to a file response (also 304) and Vary: Accept, if the format was negotiated.
+    """
+    patch_cache_control(response, **CACHE_CONTROL)
+    if negotiated:
+        patch_vary_headers(response, ["Accept"])
+    return response
+
+
+def _get_thumbnail(content: Content):
+    """
+    Return Content's thumbnail file field or None if it doesn't have one.
     """
-    thumbnail = None
-    try:
-        content = Content.objects.get(uid=uid)
-    except Content.DoesNotExist:
-        raise Http404
     # Find thumbnail, currently new place is content.preview, but content.image.thumbnail is still in use
     if content.preview:
-        thumbnail = content.preview
-    else:  # TODO: to be removed after image.thumbnails are converted to content.preview
-        try:
-            if content.mimetype.startswith("image") and content.image:
-                thumbnail = content.image.thumbnail
-            elif content.mimetype.startswith("video"):
-                thumbnail = content.video.thumbnail
-        except Exception as err:
-            logging.warning(str(err))
-    thumb_format = "png"
-
-    # Handle errors if thumbnail is not found or is not readable etc.
+        return content.preview
+    # TODO: to be removed after image.thumbnails are converted to content.preview
     try:
-        im = PIL.Image.open(thumbnail.path)
-        if thumbnail.path.endswith("png") is False:
-            thumb_format = "jpeg"
-    except AttributeError as err:
-        print("No thumbnail in non-video/image Content ", content.uid, str(err))
-        im = _get_placeholder_instance(content)
-    except IOError as err:
-        msg = "IOERROR in Content %s: %s" % (content.uid, str(err))
-        logging.error(msg)
-        return HttpResponse("ERROR: This Content has no thumbnail.", status=404)
-    except ValueError as err:
-        msg = "ValueERROR in Content, missing thumbnail %s: %s" % (content.uid, str(err))
-        logging.warning(msg)
-        im = _get_placeholder_instance(content, text="Missing thumbnail")
-    # If we got here, we should have some kind of Image object.
-    # Width and height may be W/H if the client uses preview_uri literally
-    # (it should replace them with integer).
-    if width in ["W", "%d", "%(width)d"] and height in ["H", "%d", "%(height)d"]:
-        size = 640, 480
-    else:
-        size = int(width), int(height)
+        if content.mimetype.startswith("image") and content.image:
+            return content.image.thumbnail
+        elif content.mimetype.startswith("video"):
+            return content.video.thumbnail
+    except Exception as err:
+        logging.warning(str(err))
+    return None
+
+
+def _resize_preview(im: PIL.Image.Image, size: tuple[int, int], action: str | None) -> PIL.Image.Image:
     # Crop image if requested so
     if action == "-crop":
         shorter_side = min(im.size)
@@ -131,7 +417,7 @@ def preview(request, uid: str, width: int | str, height: int | str, action=None,
         crop_size = int(max(im.size) / side_divider) + 1
         # print shorter_side, side_divider, im.size, crop_size
         size = (crop_size, crop_size)
-        im.thumbnail(size, PIL.Image.ANTIALIAS)
+        im.thumbnail(size, PIL.Image.Resampling.LANCZOS)
         margin = (max(im.size) - min(im.size)) / 2
         crop_size = min(im.size)
         if im.size[0] > im.size[1]:  # horizontal
@@ -140,29 +426,122 @@ def preview(request, uid: str, width: int | str, height: int | str, action=None,
             crop = [0, 0 + margin, crop_size, margin + crop_size]
         im = im.crop(crop)
     else:
-        im.thumbnail(size, PIL.Image.ANTIALIAS)
-    response = HttpResponse()
+        im.thumbnail(size, PIL.Image.Resampling.LANCZOS)
+    return im
+
+
+def _encode_preview(im: PIL.Image.Image, thumb_format: str) -> bytes:
     tmp = io.BytesIO()
-    if thumb_format == "png":
-        im.save(tmp, thumb_format)
-        response["Content-Type"] = "image/png"
-    else:
-        im.save(tmp, thumb_format, quality=90)
-        response["Content-Type"] = "image/jpeg"
+    if thumb_format in ("jpeg", "avif") and im.mode not in ("L", "RGB"):
+        im = im.convert("RGB")
+    im.save(tmp, thumb_format, **PREVIEW_ENCODERS[thumb_format])
     data = tmp.getvalue()
     tmp.close()
-    response.write(data)
-    response["Content-Length"] = len(data)
-    response["Accept-Ranges"] = "bytes"
+    return data
+
+
+@api_view(("GET", "HEAD"))
+def preview(request, uid: str, width: int | str, height: int | str, action=None, ext=None):
+    """
+    Return scaled JPEG/PNG/WebP/AVIF instance of the Content, which has a preview available
+    New size is determined from URL.
+    action can be '-crop'
+    Format is determined from ext and Accept header, see _preview_format().
+    Scaled previews are cached in rendition_cache.
+    """
+    try:
+        content = Content.objects.get(uid=uid)
+    except Content.DoesNotExist:
+        raise Http404
+    # Width and height may be W/H if the client uses preview_uri literally
+    # (it should replace them with integer).
+    if width in ["W", "%d", "%(width)d"] and height in ["H", "%d", "%(height)d"]:
+        size = 640, 480
+    else:
+        size = int(width), int(height)
+    thumbnail = _get_thumbnail(content)
+    thumb_format, negotiated = _preview_format(request, thumbnail, ext)
+    key = rendition_cache.key(size[0], size[1], action, thumb_format, content.updated)
+    # Respond 304 before opening any file, rendition key changes always when the preview changes
+    etag = quote_etag(hashlib.sha1(f"{content.uid}/{key}".encode()).hexdigest())
+    last_modified = int(content.updated.timestamp())
+    not_modified = _conditional_response(request, etag, last_modified)
+    if not_modified is not None:
+        return _patch_cache_headers(not_modified, negotiated)
+    data = rendition_cache.get(content.uid, key) if thumbnail else None
+    if data is None:
+        cacheable = True
+        # Handle errors if thumbnail is not found or is not readable etc.
+        try:
+            if content.preview:  # Start from the smallest pre-scaled level which is big enough
+                path = content.get_preview_level(size[0], size[1], crop=action == "-crop")
+            else:
+                path = thumbnail.path
+            im = PIL.Image.open(path)
+        except AttributeError as err:
+            print("No thumbnail in non-video/image Content ", content.uid, str(err))
+            im = _get_placeholder_instance(content)
+            cacheable = False
+        except IOError as err:
+            msg = "IOERROR in Content %s: %s" % (content.uid, str(err))
+            logging.error(msg)
+            return HttpResponse("ERROR: This Content has no thumbnail.", status=404)
+        except ValueError as err:
+            msg = "ValueERROR in Content, missing thumbnail %s: %s" % (content.uid, str(err))
+            logging.warning(msg)
+            im = _get_placeholder_instance(content, text="Missing thumbnail")
+            cacheable = False
+        # If we got here, we should have some kind of Image object.
+        im = _resize_preview(im, size, action)
+        data = _encode_preview(im, thumb_format)
+        if cacheable:
+            rendition_cache.put(content.uid, key, data)
+    content_type = PREVIEW_MIMETYPES[thumb_format]
+    response = range_response(request, io.BytesIO(data), len(data), content_type, etag, last_modified)
+    if response is None:
+        response = HttpResponse(data, content_type=content_type)
+        response["Content-Length"] = len(data)
+        response["Accept-Ranges"] = "bytes"
     if "attachment" in request.GET:
-        response["Content-Disposition"] = "attachment; filename=%s-%s.jpg" % (content.originalfilename, content.uid)
+        filename_ext = "jpg" if thumb_format == "jpeg" else thumb_format
+        response["Content-Disposition"] = "attachment; filename=%s-%s.%s" % (
+            content.originalfilename,
+            content.uid,
+            filename_ext,
+        )
     # Use 'updated' time in Last-Modified header (cache_page uses caching page)
-    response["Last-Modified"] = content.updated.strftime("%a, %d %b %Y %H:%M:%S GMT")
+    response["Last-Modified"] = http_date(last_modified)
+    response["ETag"] = etag
+    return _patch_cache_headers(response, negotiated)
+
+
+def _file_response(
+    request,
+    path: str,
+    storage: str,
+    content_type: str,
+    etag: str | None = None,
+    last_modified: int | None = None,
+) -> HttpResponseBase:
+    """
+    Return file in `path` either using X-Sendfile/X-Accel-Redirect (if configured
+    for `storage` in CONTENT_SENDFILE), as a partial response (if requested with Range header)
+    or as a FileResponse. Raise FileNotFoundError if file does not exist.
+    """
+    if storage in SENDFILE:
+        if not os.path.isfile(path):
+            raise FileNotFoundError(path)
+        return sendfile_response(path, STORAGE_LOCATIONS[storage], SENDFILE[storage], content_type)
+    f = open(path, "rb")
+    response = range_response(request, f, os.fstat(f.fileno()).st_size, content_type, etag, last_modified)
+    if response is None:
+        response = FileResponse(f, content_type=content_type)
+        response["Accept-Ranges"] = "bytes"
     return response
 
 
 @api_view(("GET", "HEAD"))
-def original(request, uid: str, filename: str) -> FileResponse | Response:
+def original(request, uid: str, filename: str) -> HttpResponseBase | Response:
     """
     Return original file.
     """
@@ -170,22 +549,29 @@ def original(request, uid: str, filename: str) -> FileResponse | Response:
         c = Content.objects.get(uid=uid)
     except Content.DoesNotExist:
         raise Http404
+    # Original file never changes, so its sha1 is a strong validator
+    etag = quote_etag(c.sha1) if c.sha1 else None
+    last_modified = int(c.filetime.timestamp()) if c.filetime else None
+    not_modified = _conditional_response(request, etag, last_modified)
+    if not_modified is not None:
+        return _patch_cache_headers(not_modified)
     try:
-        response = FileResponse(open(c.file.path, "rb"))
+        response = _file_response(request, c.file.path, "content", c.mimetype, etag, last_modified)
     except FileNotFoundError as err:
         # This is fatal file path configuration error or file is really not found
         logging.error(f"Original file for {c.uid} not found: {err}")
         return Response("Oops, requested file not found in the file system.", status=500)
-    response["Content-Type"] = c.mimetype
     disp = "attachment" if "attachment" in request.GET else "inline"
     response["Content-Disposition"] = f'{disp}; filename="{c.originalfilename}"'
-    if c.filetime:
-        response["Last-Modified"] = c.filetime.strftime("%a, %d %b %Y %H:%M:%S %z")
-    return response
+    if last_modified:
+        response["Last-Modified"] = http_date(last_modified)
+    if etag:
+        response["ETag"] = etag
+    return _patch_cache_headers(response)
 
 
 @api_view(("GET", "HEAD"))
-def instance(request, uid: str, extension: str) -> FileResponse:
+def instance(request, uid: str, extension: str) -> HttpResponseBase:
     """
     Return one of video or audio instances.
     """
@@ -193,10 +579,26 @@ def instance(request, uid: str, extension: str) -> FileResponse:
         c = Content.objects.get(uid=uid)
     except Content.DoesNotExist:
         raise Http404
+    storage = "video"
     instances = c.videoinstances.filter(extension=extension)
+    if not instances:
+        storage = "audio"
+        instances = c.audioinstances.filter(extension=extension)
     if instances:
-        response = FileResponse(open(instances[0].file.path, "rb"))
-        response["Content-Type"] = instances[0].mimetype
-        return response
+        inst = instances[0]
+        # A new instance (and id) is created every time instance is re-encoded
+        etag = quote_etag(hashlib.sha1(f"{c.sha1 or c.uid}/{inst.id}/{inst.filesize}".encode()).hexdigest())
+        last_modified = int(inst.created.timestamp())
+        not_modified = _conditional_response(request, etag, last_modified)
+        if not_modified is not None:
+            return _patch_cache_headers(not_modified)
+        try:
+            response = _file_response(request, inst.file.path, storage, inst.mimetype, etag, last_modified)
+        except FileNotFoundError as err:
+            logging.error(f"Instance file for {c.uid} not found: {err}")
+            raise Http404
+        response["Last-Modified"] = http_date(last_modified)
+        response["ETag"] = etag
+        return _patch_cache_headers(response)
     else:
         raise Http404